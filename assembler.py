@@ -52,6 +52,7 @@ def assemble(assembly_filename, mc_filename):
     
     pc = 0
     instructions = []
+    labels = {}
 
     for index, line in enumerate(lines):
         words = [word.lower() for word in line.split()]
@@ -60,6 +61,7 @@ def assemble(assembly_filename, mc_filename):
             symbols[words[1]] = int(words[2])
         elif is_label(words[0]):
             symbols[words[0]] = pc
+            labels[words[0]] = pc
             if len(words) > 1:
                 pc += 1
                 instructions.append(words[1:])
@@ -164,6 +166,10 @@ def assemble(assembly_filename, mc_filename):
         as_string = bin(machine_code)[2:].rjust(16, '0')
         machine_code_file.write(f'{as_string}\n')
 
+    machine_code_file.close()
+    # Label name -> instruction address, for debuggers and profilers
+    return labels
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         exit("Not enough arguments.")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+BatPU-2 Simulator Benchmark
+Measures the cost of each opcode in the simulator's execution loop
+"""
+
+import contextlib
+import io
+import sys
+import time
+
+from simulator import BatPU2
+
+# One representative instruction per opcode (HLT stops the run, so it is left out)
+OPCODE_SAMPLES = {
+    'nop': 0x0000,
+    'add': 0x2123,  # ADD r1, r2, r3
+    'sub': 0x3123,  # SUB r1, r2, r3
+    'nor': 0x4123,  # NOR r1, r2, r3
+    'and': 0x5123,  # AND r1, r2, r3
+    'xor': 0x6123,  # XOR r1, r2, r3
+    'rsh': 0x7103,  # RSH r1, r3
+    'ldi': 0x8105,  # LDI r1, 5
+    'adi': 0x9101,  # ADI r1, 1
+    'brh': 0xB000,  # BRH EQ (target patched to the next address)
+    'jmp': 0xA000,  # JMP (target patched to the next address)
+    'lod': 0xE120,  # LOD r1, r2, 0
+    'str': 0xF210,  # STR r2, r1, 0
+}
+
+BLOCK = 1000
+REPEAT = 5
+
+
+def build_program(opcode):
+    """Build a loop of BLOCK copies of one instruction followed by JMP 0"""
+    instruction = OPCODE_SAMPLES[opcode]
+    program = []
+    for i in range(BLOCK):
+        if opcode in ('jmp', 'brh'):
+            program.append(instruction | (i + 1))
+        else:
+            program.append(instruction)
+    program.append(0xA000)  # JMP 0
+    return program
+
+
+def build_call_program():
+    """Build a loop of CAL/RET pairs, measured together"""
+    program = []
+    ret_addr = BLOCK + 1
+    for _ in range(BLOCK):
+        program.append(0xC000 | ret_addr)  # CAL ret_addr
+    program.append(0xA000)  # JMP 0
+    program += [0x0000] * (ret_addr - len(program))
+    program.append(0xD000)  # RET
+    return program
+
+
+def time_program(program, count, **run_args):
+    """Return nanoseconds per instruction for running count instructions (best of REPEAT)"""
+    best = None
+    for _ in range(REPEAT):
+        cpu = BatPU2()
+        cpu.program = program
+        # The benchmark loops never halt, so silence the instruction limit warning
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            cpu.run(count, **run_args)
+            elapsed = time.perf_counter() - start
+        ns = elapsed * 1e9 / cpu.instruction_count
+        if best is None or ns < best:
+            best = ns
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    
+    # Warm up the interpreter before taking measurements
+    time_program(build_program('nop'), count)
+
+    print(f"\n  Per-opcode cost ({count} instructions each)")
+    print("  " + "-"*28)
+    total = 0
+    for opcode in OPCODE_SAMPLES:
+        ns = time_program(build_program(opcode), count)
+        total += ns
+        print(f"  {opcode.upper():8s} {ns:8.1f} ns/instr")
+    ns = time_program(build_call_program(), count)
+    print(f"  {'CAL/RET':8s} {ns:8.1f} ns/instr")
+    print("  " + "-"*28)
+    print(f"  {'Average':8s} {total / len(OPCODE_SAMPLES):8.1f} ns/instr")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""
+BatPU-2 Breakpoints and Watchpoints
+Breakpoints stop a run when the PC reaches an address, watchpoints after a
+LOD/STR touches a RAM address or I/O port. Both take an optional condition
+and count their hits.
+
+Conditions are Python expressions over the machine state:
+    r       registers, r[3] is r3
+    mem     data memory
+    z, c    zero and carry flags
+    pc      program counter
+    count   instructions executed
+    value   (watchpoints) the byte read or written
+e.g. "r[3] == 0 and not z" or "value > 200". Only those names, integer
+constants, r[...] and mem[...], comparisons and boolean and arithmetic
+operators are allowed: no attributes, calls or other names, so a
+condition can't run arbitrary code (the GUI takes them over HTTP).
+
+They are compiled into the threaded engine: run_debug() uses a copy of the
+CPU's handler table in which breakpoint addresses are trap handlers and, when
+watchpoints exist, LOD/STR handlers check their address first. Everything
+else runs at full speed, and runs without breakpoints don't use it at all.
+"""
+
+import ast
+from threaded import load_handlers, _slow_path
+
+CONDITION_NAMES = ('r', 'mem', 'z', 'c', 'pc', 'count', 'value')
+
+# Syntax allowed in conditions, besides names and subscripts (checked apart).
+# No ** or <<, which could build huge numbers.
+_CONDITION_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub,
+                    ast.UAdd, ast.Invert, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.FloorDiv,
+                    ast.Mod, ast.BitAnd, ast.BitOr, ast.BitXor, ast.RShift, ast.Compare, ast.Eq,
+                    ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Load,
+                    getattr(ast, 'Index', ()))  # Subscript index wrapper before Python 3.9
+
+
+def _check_condition(tree):
+    # Raise ValueError unless every node of the parsed condition is allowed
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant):
+            if type(node.value) not in (int, bool):
+                raise ValueError(f"Only integer constants are allowed in conditions: {node.value!r}")
+        elif isinstance(node, ast.Name):
+            if node.id not in CONDITION_NAMES:
+                raise ValueError(f"Unknown name in condition: {node.id} (use {', '.join(CONDITION_NAMES)})")
+        elif isinstance(node, ast.Subscript):
+            if not (isinstance(node.value, ast.Name) and node.value.id in ('r', 'mem')) \
+                    or isinstance(node.slice, ast.Slice):
+                raise ValueError("Only r[...] and mem[...] can be indexed in conditions")
+        elif not isinstance(node, _CONDITION_NODES):
+            raise ValueError(f"Not allowed in conditions: {type(node).__name__}")
+
+
+def _compile_condition(condition):
+    if condition is None or callable(condition):
+        return condition
+    if not isinstance(condition, str):
+        raise ValueError(f"Condition must be a string: {condition!r}")
+    try:
+        tree = ast.parse(condition, '<condition>', 'eval')
+    except SyntaxError as e:
+        raise ValueError(f"Invalid condition: {condition}") from e
+    _check_condition(tree)
+    return compile(tree, '<condition>', 'eval')
+
+
+def _state(cpu):
+    return {'__builtins__': {}, 'r': cpu.registers, 'mem': cpu.memory, 'z': cpu.zero_flag,
+            'c': cpu.carry_flag, 'pc': cpu.pc, 'count': cpu.instruction_count}
+
+
+class Breakpoint:
+    """Stop before executing the instruction at addr"""
+
+    def __init__(self, addr, condition=None, ignore=0):
+        self.addr = addr
+        self.condition = condition
+        self._condition = _compile_condition(condition)
+        self.ignore = ignore  # Hits to let pass before stopping
+        self.hits = 0
+
+    def matches(self, cpu, **values):
+        """True if the condition holds (or there is none)"""
+        condition = self._condition
+        if condition is None:
+            return True
+        if callable(condition):
+            return bool(condition(cpu))
+        state = _state(cpu)
+        state.update(values)
+        return bool(eval(condition, state))
+
+    def triggered(self, cpu, **values):
+        """Count a hit if the condition holds, True if the run should stop"""
+        if not self.matches(cpu, **values):
+            return False
+        self.hits += 1
+        return self.hits > self.ignore
+
+    def describe(self):
+        text = f"breakpoint at {self.addr}"
+        if self.condition is not None:
+            text += f" if {self.condition}"
+        return text
+
+    def to_dict(self):
+        return {'addr': self.addr, 'condition': self.condition if isinstance(self.condition, str) else None,
+                'ignore': self.ignore, 'hits': self.hits}
+
+
+class Watchpoint(Breakpoint):
+    """Stop after a LOD (read) or STR (write) accesses a data address or port"""
+
+    def __init__(self, address, read=False, write=True, condition=None, ignore=0):
+        super().__init__(address, condition, ignore)
+        self.read = read
+        self.write = write
+
+    def describe(self):
+        access = ('read' if self.read else '') + ('/' if self.read and self.write else '') + ('write' if self.write else '')
+        text = f"{access} watchpoint on {self.addr}"
+        if self.condition is not None:
+            text += f" if {self.condition}"
+        return text
+
+    def to_dict(self):
+        data = super().to_dict()
+        data.update(read=self.read, write=self.write)
+        return data
+
+
+class Breakpoints:
+    """The CPU's breakpoints and watchpoints
+
+    Behaves as the set of breakpoint addresses (`addr in cpu.breakpoints`,
+    add, remove, iteration), and is true when anything is set.
+    """
+
+    def __init__(self):
+        self.points = {}   # PC -> Breakpoint
+        self.watches = {}  # Data address -> Watchpoint
+        self.hit = None    # What stopped the last run
+        self.version = 0   # Bumped on every change, run_debug() rebuilds its table
+
+    def __contains__(self, addr):
+        return addr in self.points
+
+    def __iter__(self):
+        return iter(sorted(self.points))
+
+    def __len__(self):
+        return len(self.points)
+
+    def __bool__(self):
+        return bool(self.points or self.watches)
+
+    def add(self, addr, condition=None, ignore=0):
+        """Set (or replace) the breakpoint at addr"""
+        point = self.points[addr] = Breakpoint(addr, condition, ignore)
+        self.version += 1
+        return point
+
+    def remove(self, addr):
+        del self.points[addr]
+        self.version += 1
+
+    def discard(self, addr):
+        if addr in self.points:
+            self.remove(addr)
+
+    def watch(self, address, read=False, write=True, condition=None, ignore=0):
+        """Set (or replace) the watchpoint on a data address 0-255"""
+        if not 0 <= address <= 255:
+            raise ValueError(f"Not a data address: {address}")
+        point = self.watches[address] = Watchpoint(address, read, write, condition, ignore)
+        self.version += 1
+        return point
+
+    def unwatch(self, address):
+        del self.watches[address]
+        self.version += 1
+
+    def clear(self):
+        self.points.clear()
+        self.watches.clear()
+        self.version += 1
+
+    def matches(self, cpu):
+        """True if a breakpoint at the current PC has its condition met, hits are not counted"""
+        point = self.points.get(cpu.pc)
+        return point is not None and point.matches(cpu)
+
+
+def _watch_handler(registers, reg_a, imm, watched, handler):
+    # Leave the fast handler for the slow path when the address is watched
+    def watch():
+        if (registers[reg_a] + imm) & 0xFF in watched:
+            return None
+        return handler()
+    return watch
+
+
+def debug_handlers(cpu):
+    """The CPU's threaded handler table with the breakpoints compiled in"""
+    breakpoints = cpu.breakpoints
+    base = load_handlers(cpu)
+    cached = cpu._compiled.get('debug')
+    if cached is not None and cached[0] == breakpoints.version and cached[1] is base:
+        return cached[2]
+    handlers = list(base)
+    reads = {address for address, point in breakpoints.watches.items() if point.read}
+    writes = {address for address, point in breakpoints.watches.items() if point.write}
+    for pc, (opcode, reg_a, reg_b, reg_c, imm) in enumerate(cpu._decoded):
+        if opcode == 14 and reads:
+            handlers[pc] = _watch_handler(cpu.registers, reg_a, imm, reads, base[pc])
+        elif opcode == 15 and writes:
+            handlers[pc] = _watch_handler(cpu.registers, reg_a, imm, writes, base[pc])
+    for addr in breakpoints.points:
+        if 0 <= addr < len(handlers):
+            handlers[addr] = _slow_path
+    cpu._compiled['debug'] = (breakpoints.version, base, handlers)
+    return handlers
+
+
+def pending_watch(cpu, breakpoints):
+    """(Watchpoint, register) for the access the instruction at the PC is about to make
+
+    Check the watchpoint with the register's value once the instruction has
+    executed: the value is in reg B after a LOD, and came from reg B for a
+    STR. (None, None) if no watchpoint applies.
+    """
+    opcode, reg_a, reg_b, reg_c, imm = cpu._decoded[cpu.pc] if cpu.pc < len(cpu._decoded) else (0, 0, 0, 0, 0)
+    if opcode >= 14 and breakpoints.watches:
+        point = breakpoints.watches.get((cpu.registers[reg_a] + imm) & 0xFF)
+        if point is not None and (point.read if opcode == 14 else point.write):
+            return point, reg_b
+    return None, None
+
+
+def _execute(cpu, breakpoints):
+    # One instruction through the interpreter, returns (executed, watchpoint hit)
+    point, register = pending_watch(cpu, breakpoints)
+    if not cpu.execute_one():
+        return False, None
+    if point is not None and point.triggered(cpu, value=cpu.registers[register]):
+        return True, point
+    return True, None
+
+
+def run_debug(cpu, max_instructions, resume=True):
+    """Run like run_threaded(), stopping at breakpoints and watchpoints
+
+    With resume, a breakpoint on the starting PC is not checked, so a stopped
+    run can be continued. Returns the Breakpoint or Watchpoint that stopped
+    the run (also kept in cpu.breakpoints.hit), or None.
+    """
+    breakpoints = cpu.breakpoints
+    breakpoints.hit = None
+    if cpu.halted:
+        return None
+    handlers = debug_handlers(cpu)
+    points = breakpoints.points
+
+    # The first instruction runs whatever its breakpoint says
+    if resume and cpu.instruction_count < max_instructions and cpu.pc in points:
+        executed, hit = _execute(cpu, breakpoints)
+        if not executed or hit is not None:
+            breakpoints.hit = hit
+            return hit
+
+    pc = cpu.pc
+    count = cpu.instruction_count
+    while count < max_instructions:
+        next_pc = handlers[pc]()
+        if next_pc is None:
+            cpu.pc = pc
+            cpu.instruction_count = count
+            point = points.get(pc)
+            if point is not None and point.triggered(cpu):
+                breakpoints.hit = point
+                return point
+            executed, hit = _execute(cpu, breakpoints)
+            if not executed or hit is not None:
+                breakpoints.hit = hit
+                return hit
+            pc = cpu.pc
+            count = cpu.instruction_count
+            continue
+        pc = next_pc
+        count += 1
+    cpu.pc = pc
+    cpu.instruction_count = count
+    return None
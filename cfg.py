@@ -0,0 +1,267 @@
+"""
+BatPU-2 Control-Flow Graph
+Splits a program into basic blocks and links them up:
+
+  successors    where control can go next: JMP and BRH targets, fall-through,
+                CAL into the callee, RET back to the instruction after every
+                CAL of the subroutine(s) the RET belongs to (and on, past an
+                empty stack, when the RET is reachable from the top level)
+  local         the same within a subroutine: a CAL falls through to its
+                return site, a RET ends the subroutine
+
+On top of that come the call targets, the code reachable from address 0,
+and the loops: natural loops of the local graph (a back edge to a block that
+dominates it), nested by their bodies.
+
+The program can't change while it is loaded, so program_cfg() builds the
+graph once per program hash and every CPU running that program shares it.
+"""
+
+from collections import OrderedDict
+
+# Opcodes that end a basic block
+BLOCK_TERMINATORS = (1, 10, 11, 12, 13)  # HLT, JMP, BRH, CAL, RET
+
+# Graphs kept by program_cfg(): program hash -> CFG
+CFG_CACHE_SIZE = 64
+_graphs = OrderedDict()
+
+
+class Block:
+    """A basic block, program[start:end]"""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.successors = []    # Block starts, see the module docstring
+        self.predecessors = []
+        self.local = []         # Successors within the subroutine
+        self.local_predecessors = []
+
+    @property
+    def last(self):
+        return self.end - 1
+
+
+class Loop:
+    """A natural loop"""
+
+    def __init__(self, header, tails, blocks):
+        self.header = header      # Start of the block every iteration goes through
+        self.tails = tails        # Starts of the blocks jumping back to header
+        self.blocks = blocks      # Starts of the blocks in the body, header included
+        self.parent = None        # Innermost enclosing Loop
+        self.children = []
+        self.depth = 1            # 1 for outermost loops
+
+    def __contains__(self, start):
+        return start in self.blocks
+
+
+def _control(word):
+    # (opcode, JMP/BRH/CAL target) of an instruction word
+    return word >> 12, word & 0x3FF
+
+
+def _reachable(starts, edges):
+    # Block starts reachable from starts along edges (start -> successor starts)
+    seen = set(starts)
+    pending = list(seen)
+    while pending:
+        for successor in edges[pending.pop()]:
+            if successor not in seen:
+                seen.add(successor)
+                pending.append(successor)
+    return seen
+
+
+def _immediate_dominators(roots, blocks):
+    # Cooper, Harvey and Kennedy's algorithm over the local graph, with a virtual
+    # root (None) above the roots. Returns block start -> immediate dominator.
+    postorder = []
+    visited = set()
+    for root in roots:
+        if root in visited:
+            continue
+        visited.add(root)
+        stack = [(root, iter(blocks[root].local))]
+        while stack:
+            start, successors = stack[-1]
+            for successor in successors:
+                if successor not in visited:
+                    visited.add(successor)
+                    stack.append((successor, iter(blocks[successor].local)))
+                    break
+            else:
+                stack.pop()
+                postorder.append(start)
+    number = {start: i for i, start in enumerate(postorder)}
+    number[None] = len(postorder)
+    idom = {None: None}
+
+    def intersect(a, b):
+        while a != b:
+            while number[a] < number[b]:
+                a = idom[a]
+            while number[b] < number[a]:
+                b = idom[b]
+        return a
+
+    roots = set(roots)
+    changed = True
+    while changed:
+        changed = False
+        for start in reversed(postorder):
+            candidates = [p for p in blocks[start].local_predecessors if p in idom]
+            if start in roots:
+                candidates.append(None)
+            new = candidates[0]
+            for predecessor in candidates[1:]:
+                new = intersect(predecessor, new)
+            if start not in idom or idom[start] != new:
+                idom[start] = new
+                changed = True
+    del idom[None]
+    return idom
+
+
+class CFG:
+    """Control-flow graph of a program (a sequence of 16-bit words)"""
+
+    def __init__(self, program):
+        length = len(program)
+        controls = [_control(word) for word in program]
+
+        leaders = {0} if length else set()
+        for pc, (opcode, target) in enumerate(controls):
+            if opcode in (10, 11, 12):  # JMP, BRH, CAL
+                if target < length:
+                    leaders.add(target)
+            if opcode in BLOCK_TERMINATORS and pc + 1 < length:
+                leaders.add(pc + 1)
+        self.leaders = sorted(leaders)
+        self.blocks = {start: Block(start, end)
+                       for start, end in zip(self.leaders, self.leaders[1:] + [length])}
+        self._block_at = [0] * length
+        for block in self.blocks.values():
+            self._block_at[block.start:block.end] = [block.start] * (block.end - block.start)
+
+        # Call site -> callee entry (None if past the end of the program)
+        self.calls = {}
+        for block in self.blocks.values():
+            opcode, target = controls[block.last]
+            fall_through = [block.end] if block.end < length else []
+            jump = [target] if target < length else []
+            if opcode == 10:  # JMP
+                block.local = jump
+            elif opcode == 11:  # BRH
+                block.local = jump + [s for s in fall_through if s not in jump]
+            elif opcode == 12:  # CAL
+                block.local = fall_through
+                self.calls[block.last] = target if target < length else None
+            elif opcode in (1, 13):  # HLT, RET
+                block.local = []
+            else:
+                block.local = fall_through
+            for successor in block.local:
+                self.blocks[successor].local_predecessors.append(block.start)
+        self.call_targets = sorted({t for t in self.calls.values() if t is not None})
+
+        # Subroutine entry -> starts of the blocks in its body
+        self.subroutines = {entry: _reachable([entry], {s: b.local for s, b in self.blocks.items()})
+                            for entry in self.call_targets}
+        top_level = _reachable([0], {s: b.local for s, b in self.blocks.items()}) if length else set()
+        return_sites = {entry: [] for entry in self.call_targets}
+        for site, target in self.calls.items():
+            if target is not None and site + 1 < length:
+                return_sites[target].append(site + 1)
+
+        for block in self.blocks.values():
+            opcode, target = controls[block.last]
+            if opcode == 12:  # CAL
+                block.successors = [target] if target < length else []
+            elif opcode == 13:  # RET
+                sites = set()
+                for entry, body in self.subroutines.items():
+                    if block.start in body:
+                        sites.update(return_sites[entry])
+                if block.start in top_level and block.end < length:
+                    sites.add(block.end)  # Stack underflow, execution carries on
+                block.successors = sorted(sites)
+            else:
+                block.successors = list(block.local)
+            for successor in block.successors:
+                self.blocks[successor].predecessors.append(block.start)
+
+        # Block starts reachable from the reset vector
+        self.reachable = _reachable([0], {s: b.successors for s, b in self.blocks.items()}) if length else set()
+
+        self.idom = _immediate_dominators([0] + self.call_targets if length else [], self.blocks)
+        self.loops = self._find_loops()
+
+    def block_at(self, pc):
+        """The Block containing address pc"""
+        return self.blocks[self._block_at[pc]]
+
+    def dominates(self, a, b):
+        """Whether every local path to block b from its subroutine entry (or 0) goes through block a"""
+        while b is not None:
+            if b == a:
+                return True
+            b = self.idom.get(b)
+        return False
+
+    def unreachable(self):
+        """Starts of the blocks no execution from address 0 can get to"""
+        return sorted(set(self.blocks) - self.reachable)
+
+    def loop_at(self, pc):
+        """The innermost Loop containing address pc, or None"""
+        start = self._block_at[pc]
+        inner = None
+        for loop in self.loops:
+            if start in loop.blocks and (inner is None or loop.depth > inner.depth):
+                inner = loop
+        return inner
+
+    def _find_loops(self):
+        # Natural loops of the local graph, one per header, outermost first
+        tails = {}
+        for start, block in self.blocks.items():
+            for successor in block.local:
+                if start in self.idom and self.dominates(successor, start):
+                    tails.setdefault(successor, []).append(start)
+        loops = []
+        for header, back in sorted(tails.items()):
+            body = {header}
+            pending = [t for t in back if t != header]
+            body.update(pending)
+            while pending:
+                for predecessor in self.blocks[pending.pop()].local_predecessors:
+                    if predecessor not in body and predecessor in self.idom:
+                        body.add(predecessor)
+                        pending.append(predecessor)
+            loops.append(Loop(header, back, frozenset(body)))
+
+        # Nest each loop in the smallest other loop whose body holds its header
+        loops.sort(key=lambda loop: (-len(loop.blocks), loop.header))
+        for i, loop in enumerate(loops):
+            for outer in reversed(loops[:i]):
+                if loop.header in outer.blocks and loop.blocks <= outer.blocks:
+                    loop.parent = outer
+                    loop.depth = outer.depth + 1
+                    outer.children.append(loop)
+                    break
+        return loops
+
+
+def program_cfg(cpu):
+    """The CFG of the CPU's program, shared by every CPU running it"""
+    graph = _graphs.get(cpu.program_hash)
+    if graph is None:
+        if len(_graphs) >= CFG_CACHE_SIZE:
+            _graphs.popitem(last=False)
+        graph = _graphs[cpu.program_hash] = CFG(cpu.program)
+    else:
+        _graphs.move_to_end(cpu.program_hash)
+    return graph
@@ -0,0 +1,115 @@
+"""
+BatPU-2 Scripted Controller
+Feeds the controller_input port from a timeline of button events, so games
+can be played headlessly at full emulation speed.
+
+Input script format, one event per line:
+
+    # comment
+    f120   right        at frame 120, hold RIGHT
+    f135   -            release everything
+    5000   a+left       at instruction 5000, hold A and LEFT
+    6000   0x24         masks can also be given as numbers
+
+`fN` fires once N frames have been shown (buffer_screen), a plain `N` once N
+instructions have run. Events fire in file order and a mask is held until the
+next event replaces it. Which events are due only depends on the CPU's
+counters, so the timeline follows the CPU back in time when an earlier state
+is restored.
+"""
+
+# Button bits, as read by the bundled games (see programs/tetris.as)
+BUTTONS = {'left': 1, 'down': 2, 'right': 4, 'up': 8, 'b': 16, 'a': 32}
+
+FRAME = 'f'
+INSTRUCTION = 'i'
+
+
+def parse_mask(text):
+    """Parse a button mask: '-', a number, or button names joined with '+'"""
+    if text == '-':
+        return 0
+    if text[0].isdigit():
+        mask = int(text, 0)
+    else:
+        mask = 0
+        for name in text.lower().split('+'):
+            if name not in BUTTONS:
+                raise ValueError(f"Unknown button: {name}")
+            mask |= BUTTONS[name]
+    if not 0 <= mask <= 255:
+        raise ValueError(f"Button mask out of range: {text}")
+    return mask
+
+
+def parse_script(text):
+    """Parse an input script into a list of (kind, when, mask) events"""
+    events = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise ValueError(f"Line {line_number}: expected <when> <buttons>")
+        when, mask = fields
+        try:
+            if when[0] in 'fF':
+                events.append((FRAME, int(when[1:]), parse_mask(mask)))
+            else:
+                events.append((INSTRUCTION, int(when), parse_mask(mask)))
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: {e}") from None
+    return events
+
+
+class InputTimeline:
+    """Controller device replaying a list of (kind, when, mask) events"""
+
+    def __init__(self, events=()):
+        self.events = list(events)
+        self.rewind()
+
+    @classmethod
+    def load(cls, filename):
+        """Load an input script file"""
+        with open(filename, 'r') as f:
+            return cls(parse_script(f.read()))
+
+    def rewind(self):
+        """Start again from the first event with no buttons held"""
+        self.position = 0
+        self.mask = 0
+        self.count = 0
+
+    def attach(self, cpu):
+        """Install the timeline on the CPU's controller_input port"""
+        cpu.attach_device('controller_input', read=self.read)
+
+    def next_change(self, cpu):
+        """Instruction count at which the held mask can next change, or None
+
+        None means not before another frame is shown. Used to fast-forward
+        idle loops (see idle.py).
+        """
+        if self.position < len(self.events):
+            kind, when, mask = self.events[self.position]
+            if kind == INSTRUCTION:
+                return when
+        return None
+
+    def read(self, cpu):
+        """Port handler: apply every event that is due and return the held mask"""
+        if cpu.instruction_count < self.count:
+            self.rewind()  # An earlier state was restored, replay from the start
+        self.count = cpu.instruction_count
+        events = self.events
+        position = self.position
+        while position < len(events):
+            kind, when, mask = events[position]
+            if (cpu.frame_count if kind == FRAME else cpu.instruction_count) < when:
+                break
+            self.mask = mask
+            position += 1
+        self.position = position
+        return self.mask
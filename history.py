@@ -0,0 +1,194 @@
+"""
+BatPU-2 Execution History
+Time-travel debugging: while the CPU runs through a History it is
+checkpointed every `interval` instructions, and going back in time restores
+the nearest earlier checkpoint and re-executes forward to the target, so a
+step back costs at most `interval` instructions.
+
+Replay is exact because execution is deterministic: the RNG state is part of
+the snapshot and controller timelines follow the CPU's counters.
+
+Checkpoints are snapshot() blobs XORed with the previous checkpoint and zlib
+compressed (consecutive states differ in a few bytes), with a whole snapshot
+every KEYFRAME_INTERVAL checkpoints. Once `capacity` checkpoints are stored,
+the oldest keyframe and its deltas are dropped.
+"""
+
+import bisect
+import zlib
+from breakpoints import pending_watch
+from idle import CycleTable
+
+KEYFRAME_INTERVAL = 64
+
+
+def _xor(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+class History:
+    """Checkpointed execution of a CPU, with reverse step and reverse continue"""
+
+    def __init__(self, cpu, interval=1000, capacity=16384):
+        self.cpu = cpu
+        self.interval = interval
+        # Keep whole keyframe groups
+        self.capacity = max(capacity, KEYFRAME_INTERVAL) // KEYFRAME_INTERVAL * KEYFRAME_INTERVAL
+        # Optional profiler.Profile/AccessProfile fed by step() and run(), not by replays
+        self.profile = None
+        self.clear()
+
+    def clear(self):
+        """Forget the past, the current state becomes the first checkpoint
+
+        Call it whenever the CPU state is changed from outside (reset, new
+        program, restore).
+        """
+        self.counts = []  # Instruction count of each checkpoint, ascending
+        self.frames = []  # Compressed keyframe or delta of each checkpoint
+        self.last = None  # Newest checkpoint, uncompressed
+        self.checkpoint()
+
+    @property
+    def start(self):
+        """Earliest instruction count that can be reached"""
+        return self.counts[0]
+
+    def checkpoint(self):
+        """Record the current state"""
+        cpu = self.cpu
+        if self.counts and self.counts[-1] >= cpu.instruction_count:
+            return
+        if len(self.counts) >= self.capacity:
+            del self.counts[:KEYFRAME_INTERVAL]
+            del self.frames[:KEYFRAME_INTERVAL]
+        state = cpu.snapshot()
+        if len(self.counts) % KEYFRAME_INTERVAL:
+            self.frames.append(zlib.compress(_xor(state, self.last), 1))
+        else:
+            self.frames.append(zlib.compress(state, 1))
+        self.counts.append(cpu.instruction_count)
+        self.last = state
+
+    def _state(self, index):
+        # Keyframe of the group, then the deltas up to index
+        first = index - index % KEYFRAME_INTERVAL
+        state = zlib.decompress(self.frames[first])
+        for i in range(first + 1, index + 1):
+            state = _xor(state, zlib.decompress(self.frames[i]))
+        return state
+
+    def _rewind(self, index):
+        # Restore checkpoint index, later checkpoints are recorded again on replay
+        state = self._state(index)
+        self.cpu.restore(state)
+        del self.counts[index + 1:]
+        del self.frames[index + 1:]
+        self.last = state
+
+    def step(self):
+        """Execute one instruction, like cpu.execute_one()"""
+        cpu = self.cpu
+        cpu.breakpoints.hit = None
+        if self.profile is None:
+            if not cpu.execute_one():
+                return False
+        else:
+            count = cpu.instruction_count
+            self.profile.run(cpu, count + 1)
+            if cpu.instruction_count == count:
+                return False
+        if cpu.instruction_count % self.interval == 0:
+            self.checkpoint()
+        return True
+
+    def run(self, max_instructions, engine=None):
+        """Run until halted or instruction_count reaches max_instructions
+
+        Stops at breakpoints and watchpoints like cpu.advance(), and returns
+        the one that stopped the run.
+        """
+        cpu = self.cpu
+        cpu.breakpoints.hit = None
+        if cpu.breakpoints and self.profile is not None:
+            # Profiling loops don't check breakpoints, go one instruction at a time
+            breakpoints = cpu.breakpoints
+            while cpu.instruction_count < max_instructions:
+                watch, register = pending_watch(cpu, breakpoints)
+                if not self.step():
+                    break
+                point = None
+                if watch is not None and watch.triggered(cpu, value=cpu.registers[register]):
+                    point = watch
+                elif cpu.pc in breakpoints.points and breakpoints.points[cpu.pc].triggered(cpu):
+                    point = breakpoints.points[cpu.pc]
+                if point is not None:
+                    breakpoints.hit = point
+                    return point
+            return None
+        return self._advance(max_instructions, engine, self.profile, True)
+
+    def _advance(self, max_instructions, engine=None, profile=None, debug=False):
+        # Run at engine speed, stopping at each checkpoint boundary. An idle
+        # loop skip (cpu.fast_forward) may cross boundaries, up to
+        # max_instructions, and gets one checkpoint where it lands. The
+        # chunks share one CycleTable so cycle_check sees loops spanning them.
+        cpu = self.cpu
+        interval = self.interval
+        resume = True
+        cycles = CycleTable()
+        while cpu.instruction_count < max_instructions and not cpu.halted:
+            count = cpu.instruction_count
+            skipped = cpu.idle_skipped
+            hit = cpu.advance(min((count // interval + 1) * interval, max_instructions),
+                              engine, profile, debug, resume, idle_limit=max_instructions, cycles=cycles)
+            resume = False  # Later chunks continue the same run
+            if cpu.instruction_count % interval == 0 or cpu.idle_skipped != skipped:
+                self.checkpoint()
+            if hit is not None:
+                return hit
+            if cpu.instruction_count == count:
+                break
+        return None
+
+    def seek(self, count, engine=None):
+        """Go to the state after `count` instructions, as far back as start"""
+        count = max(count, self.counts[0])
+        if count < self.cpu.instruction_count:
+            self._rewind(bisect.bisect_right(self.counts, count) - 1)
+        self._advance(count, engine)
+
+    def reverse_step(self, count=1):
+        """Step back `count` instructions, returns False at the start of history"""
+        if self.cpu.instruction_count <= self.counts[0]:
+            return False
+        self.seek(self.cpu.instruction_count - count)
+        return True
+
+    def reverse_continue(self):
+        """Go back to the last time the PC was on a breakpoint with its condition met
+
+        Returns False (and stops at the start of history) if there is none.
+        Watchpoints and hit counts are not used going backwards.
+        """
+        cpu = self.cpu
+        breakpoints = cpu.breakpoints
+        end = cpu.instruction_count
+        index = bisect.bisect_left(self.counts, end) - 1 if breakpoints else -1
+        while index >= 0:
+            # Replay this checkpoint's span, noting the last breakpoint hit
+            cpu.restore(self._state(index))
+            hit = None
+            while cpu.instruction_count < end:
+                if cpu.pc in breakpoints and breakpoints.matches(cpu):
+                    hit = cpu.instruction_count
+                if not cpu.execute_one():
+                    break
+            if hit is not None:
+                self._rewind(index)
+                self._advance(hit)
+                return True
+            end = self.counts[index]
+            index -= 1
+        self._rewind(0)
+        return False
@@ -0,0 +1,220 @@
+"""
+BatPU-2 High-Level Emulation
+Runs native Python implementations in place of recognised guest subroutines.
+
+A Routine is identified by the hash of its first `length` instruction words,
+with JMP/BRH targets taken relative to its entry so it hashes the same
+wherever it was assembled. Any CAL target of the loaded program whose words
+match a registered routine is hooked: with cpu.hle set, the accelerated
+engine (see simulator.run_accelerated()) calls the routine's function when
+the PC reaches it, then returns like its RET would.
+
+The function gets the CPU and must leave it exactly as the guest code would:
+the registers, flags and memory it declares, port writes in the same order
+(use load() and store()), and it returns the number of instructions the
+guest code executes, RET included, so instruction_count stays exact. With
+cpu.hle_verify every call is checked against the interpreter instead, and
+HLEMismatch is raised on any difference.
+"""
+
+import hashlib
+from cfg import program_cfg
+
+# Registered routines: (length, digest) -> Routine
+ROUTINES = {}
+_version = 0  # Bumped on every register(), hooks() are found again
+
+
+class HLEMismatch(Exception):
+    """A native routine doesn't do what the guest code does"""
+
+
+def digest_at(program, entry, length):
+    """Hash of the `length` words at entry, jump targets made relative to it"""
+    words = []
+    for word in program[entry:entry + length]:
+        if (word >> 12) in (10, 11):  # JMP, BRH
+            word = (word & ~0x3FF) | ((word - entry) & 0x3FF)
+        words.append(word)
+    return hashlib.sha256(b''.join(w.to_bytes(2, 'big') for w in words)).hexdigest()
+
+
+def load(cpu, address):
+    """Read a data address the way LOD does, ports included"""
+    address &= 0xFF
+    if address >= 240:
+        return cpu._port_readers[address - 240](cpu)
+    return cpu.memory[address]
+
+
+def store(cpu, address, value):
+    """Write a data address the way STR does, ports included"""
+    address &= 0xFF
+    if address >= 240:
+        cpu._port_writers[address - 240](cpu, value)
+    else:
+        cpu.memory[address] = value
+
+
+class Routine:
+    """Native implementation of a guest subroutine"""
+
+    def __init__(self, name, digest, length, function, limit, registers=(), memory=()):
+        self.name = name
+        self.digest = digest
+        self.length = length      # Words hashed, from the entry
+        self.function = function  # function(cpu) -> instructions executed
+        self.limit = limit        # Most instructions a call can take, RET included
+        self.registers = frozenset(registers)  # Registers it may write
+        self.memory = frozenset(memory)        # RAM addresses it may write
+        self.calls = 0
+
+    @classmethod
+    def at(cls, program, entry, length, function, limit, **declared):
+        """The routine whose code is at program[entry:entry + length]"""
+        return cls(f'routine@{entry}', digest_at(program, entry, length), length, function, limit, **declared)
+
+
+def register(routine):
+    """Hook routine wherever a program has a CAL to its code"""
+    global _version
+    ROUTINES[(routine.length, routine.digest)] = routine
+    _version += 1
+    return routine
+
+
+def hooks(cpu):
+    """Entry address -> Routine for the CPU's program"""
+    cached = cpu._compiled.get('hle')
+    if cached is not None and cached[0] == _version:
+        return cached[1]
+    program = cpu.program
+    lengths = {length for length, _ in ROUTINES}
+    found = {}
+    for entry in program_cfg(cpu).call_targets:
+        for length in lengths:
+            routine = ROUTINES.get((length, digest_at(program, entry, length)))
+            if routine is not None and entry + length <= len(program):
+                found[entry] = routine
+    cpu._compiled['hle'] = (_version, found)
+    return found
+
+
+def _call(cpu, routine):
+    # The routine, then its RET
+    count = routine.function(cpu)
+    routine.calls += 1
+    depth = cpu.stack_depth - 1
+    cpu.stack_depth = depth
+    cpu.pc = cpu.stack[depth]
+    cpu.instruction_count += count
+
+
+def _fields(cpu):
+    return {'pc': cpu.pc, 'instruction_count': cpu.instruction_count,
+            'zero_flag': cpu.zero_flag, 'carry_flag': cpu.carry_flag,
+            'pixel_x': cpu.pixel_x, 'pixel_y': cpu.pixel_y, 'stack': cpu.call_stack,
+            'frame_count': cpu.frame_count, 'char_count': cpu.char_count,
+            'number_display': cpu.number_display, 'framebuffer': bytes(cpu.framebuffer),
+            **{f'r{i}': v for i, v in enumerate(cpu.registers)},
+            **{f'mem[{i}]': v for i, v in enumerate(cpu.memory)}}
+
+
+def verify(cpu, routine):
+    """Run a hooked call both ways and compare, the CPU ends up as the interpreter left it"""
+    before = cpu.snapshot()
+    start = _fields(cpu)
+    _call(cpu, routine)
+    native, native_fields = cpu.snapshot(), _fields(cpu)
+    cpu.restore(before)
+    depth = cpu.stack_depth
+    for _ in range(routine.limit):
+        if not cpu.execute_one() or cpu.stack_depth < depth:
+            break
+    if cpu.stack_depth >= depth:
+        raise HLEMismatch(f"{routine.name}: guest code did not return within {routine.limit} instructions")
+    guest = _fields(cpu)
+    if cpu.snapshot() != native:
+        diff = ', '.join(f'{name} {native_fields[name]!r} != {value!r}' for name, value in guest.items()
+                         if native_fields[name] != value) or 'other state'
+        raise HLEMismatch(f"{routine.name} at {start['pc']}: native != guest: {diff}")
+    undeclared = [name for name, value in guest.items() if value != start[name] and (
+        name.startswith('r') and int(name[1:]) not in routine.registers
+        or name.startswith('mem') and int(name[4:-1]) not in routine.memory)]
+    if undeclared:
+        raise HLEMismatch(f"{routine.name}: writes undeclared {', '.join(undeclared)}")
+
+
+def _trap(routine, check):
+    def trap(cpu, max_instructions):
+        # Left to the guest code if it could overrun the run or has nowhere to return
+        if not cpu.stack_depth or cpu.instruction_count + routine.limit > max_instructions:
+            return False
+        check(cpu, routine)
+        return True
+    return trap
+
+
+def traps(cpu):
+    """Traps for threaded.run_traps() calling the routines at the hooked entries"""
+    check = verify if cpu.hle_verify else _call
+    return {entry: _trap(routine, check) for entry, routine in hooks(cpu).items()}
+
+
+# Routines of the bundled programs
+
+def _sum_neighbor(cpu):
+    # gol.as .sum_neighbor: r3 += pixel (r5, r6) if it is within the r9 boundary mask
+    r = cpu.registers
+    for coordinate, count in ((r[5], 3), (r[6], 5)):
+        r[14] = coordinate & r[9]
+        cpu.zero_flag = r[14] == 0
+        if r[14]:
+            return count
+    store(cpu, r[15] - 8, r[5])  # pixel_x
+    store(cpu, r[15] - 7, r[6])  # pixel_y
+    r[14] = load(cpu, r[15] - 4)  # load_pixel
+    total = r[14] + r[3]
+    cpu.carry_flag = total > 255
+    r[3] = total & 0xFF
+    cpu.zero_flag = r[3] == 0
+    return 9
+
+
+def _char(cpu):
+    # calculator.as .char: draw the 3x5 glyph at mem[r1] (15 bits, MSB first) at (r2, r3)
+    r = cpu.registers
+    glyph, x = r[1], r[2]
+    bits = load(cpu, glyph)
+    bit = 128
+    count = 4
+    for row in range(5):
+        count += 1
+        for column in range(3):
+            count += 8
+            if bits & bit:
+                store(cpu, r[15] - 8, (x + column) & 0xFF)  # pixel_x
+                store(cpu, r[15] - 7, r[3])                 # pixel_y
+                store(cpu, r[15] - 6, 0)                    # draw_pixel
+                count += 3
+            bit >>= 1
+            if not bit:
+                bits = load(cpu, glyph + 1)
+                bit = 128
+                count += 2
+        r[3] = (r[3] + 1) & 0xFF
+        count += 4
+    r[4], r[5], r[6], r[7], r[8] = x, bits, bit, 0, 0
+    y = r[3] - 5
+    cpu.carry_flag = y < 0
+    r[3] = y & 0xFF
+    cpu.zero_flag = r[3] == 0
+    return count + 2
+
+
+register(Routine('gol.as .sum_neighbor',
+                 '315fc0f1f16c315fe85f04129c65ce5004fc4f8938601c8c8dbd03e0872a32b7',
+                 9, _sum_neighbor, 9, registers=(3, 14)))
+register(Routine('calculator.as .char',
+                 'e58a923644b1c74a9954457615a3bec9cfc2bec1d202d1f58aef9f147c62b59c',
+                 24, _char, 230, registers=(3, 4, 5, 6, 7, 8)))
@@ -0,0 +1,212 @@
+"""
+BatPU-2 Idle and Infinite Loops
+Both are found by comparing whole machine states (everything but the
+instruction count, see _state_key()): a deterministic machine that is back
+in a state it was in will do the same thing again, as long as its input
+hasn't changed.
+
+Idle-loop fast-forward: games spend most of their time polling
+controller_input in a tight loop, waiting for a button. run_idle() watches
+those reads: when the CPU reads the controller at the same PC twice with
+the whole machine state unchanged and the same value read every time in
+between, the loop is provably idle. Nothing changes until the input does,
+so whole loop periods are skipped by adding to instruction_count, up to the
+next point where the input can change or the instruction limit.
+
+The result is exactly the state the engine would have reached, only sooner.
+It is only sound when the controller is the only thing outside the CPU, so
+BatPU2.advance() uses it with the built-in devices, and a controller that
+can tell when its input next changes (see InputTimeline.next_change()).
+
+Infinite loops: find_cycle() hashes the state after every backward jump
+into a bounded table and stops the run as soon as a state comes back with
+no input pending, which proves the program will loop forever.
+"""
+
+from threaded import load_handlers
+
+# States find_cycle() remembers, it then starts over remembering every
+# other backward jump, then every fourth... so long loops are found too
+CYCLE_TABLE_SIZE = 4096
+
+
+class _IdleLoop(Exception):
+    """Raised by the controller wrapper, the read has not been executed"""
+
+    def __init__(self, skip):
+        super().__init__(skip)
+        self.skip = skip
+
+
+def never(cpu):
+    """next_change() of a controller whose input never changes"""
+    return None
+
+
+def _state_key(cpu):
+    # The whole machine state except the instruction count
+    count = cpu.instruction_count
+    cpu.instruction_count = 0
+    try:
+        return cpu.snapshot()
+    finally:
+        cpu.instruction_count = count
+
+
+class IdleDetector:
+    """controller_input wrapper looking for idle loops"""
+
+    def __init__(self, read, next_change, limit):
+        self.read = read
+        self.next_change = next_change
+        self.limit = limit  # Instruction count skips may reach
+        self.value = None
+        self.reads = {}  # PC -> (instruction count, state key) of the last read there
+
+    def __call__(self, cpu):
+        value = self.read(cpu)
+        if value != self.value:
+            # Reads before this one saw other input, they prove nothing
+            self.value = value
+            self.reads.clear()
+        pc = cpu.pc
+        count = cpu.instruction_count
+        key = _state_key(cpu)
+        last = self.reads.get(pc)
+        self.reads[pc] = (count, key)
+        if last is not None and last[1] == key:
+            limit = self.limit
+            change = self.next_change(cpu)
+            if change is not None:
+                limit = min(limit, change)
+            period = count - last[0]
+            skip = (limit - count) // period * period
+            if skip > 0:
+                raise _IdleLoop(skip)
+        return value
+
+
+def run_idle(cpu, max_instructions, engine, next_change=never, skip_limit=None):
+    """Run with an engine, fast-forwarding idle controller polling loops
+
+    next_change(cpu) gives the instruction count at which the controller's
+    input can next change, or None if it can't. A skip goes as far as
+    skip_limit (default max_instructions), so it may end the run past
+    max_instructions. Returns the number of instructions skipped (they still
+    count in instruction_count).
+    """
+    readers = cpu._port_readers
+    cpu._port_readers = list(readers)
+    limit = max_instructions if skip_limit is None else skip_limit
+    cpu._port_readers[15] = IdleDetector(readers[15], next_change, limit)
+    skipped = 0
+    try:
+        while True:
+            try:
+                engine(cpu, max_instructions)
+                return skipped
+            except _IdleLoop as loop:
+                # Same state, pc still on the read, loop.skip instructions later
+                cpu.instruction_count += loop.skip
+                skipped += loop.skip
+    finally:
+        cpu._port_readers = readers
+
+
+class Cycle:
+    """A provably infinite loop found by find_cycle()"""
+
+    def __init__(self, first, period, low, high):
+        self.first = first    # Instruction count when the state was first seen
+        self.period = period  # Instructions per turn of the loop
+        self.low = low        # PC range covered by the loop
+        self.high = high
+
+    def describe(self):
+        return f"infinite loop over PCs {self.low}-{self.high}, repeating every {self.period} instruction{'s' if self.period != 1 else ''}"
+
+
+def _loop_range(cpu, period):
+    # Step one turn of the loop for the PCs it covers, then go back
+    state = cpu.snapshot()
+    low = high = cpu.pc
+    for _ in range(period):
+        cpu.execute_one()
+        low = min(low, cpu.pc)
+        high = max(high, cpu.pc)
+    cpu.restore(state)
+    return low, high
+
+
+class CycleTable:
+    """States find_cycle() has seen, kept to carry one run on over several calls"""
+
+    def __init__(self, capacity=CYCLE_TABLE_SIZE):
+        self.capacity = capacity
+        self.seen = {}      # State key -> instruction count
+        self.value = None   # Controller input the states were seen with
+        self.stride = 1     # Backward jumps per state remembered
+        self.jumps = 0
+
+
+def find_cycle(cpu, max_instructions, next_change=never, table=None):
+    """Run like run_threaded(), stopping when the machine provably loops forever
+
+    After each backward jump (every loop takes one) the state is looked up
+    in a table of states seen since the controller input last changed. A
+    match with no input pending (next_change(cpu) is None) stops the run
+    there. Passing the same CycleTable to calls continuing one run (like
+    History's chunks) finds loops spanning calls. Returns the Cycle, or None
+    if the run ended normally.
+    """
+    if cpu.halted:
+        return None
+    handlers = load_handlers(cpu)
+    readers = cpu._port_readers
+    read = readers[15]
+    if table is None:
+        table = CycleTable()
+    seen = table.seen
+
+    def controller(cpu):
+        # States seen with other input prove nothing
+        value = read(cpu)
+        if value != table.value:
+            table.value = value
+            seen.clear()
+        return value
+
+    cpu._port_readers = list(readers)
+    cpu._port_readers[15] = controller
+    try:
+        pc = cpu.pc
+        count = cpu.instruction_count
+        while count < max_instructions:
+            next_pc = handlers[pc]()
+            if next_pc is None:
+                cpu.pc = pc
+                cpu.instruction_count = count
+                if not cpu.execute_one():
+                    return None
+                next_pc = cpu.pc
+            count += 1
+            if next_pc <= pc:
+                cpu.pc = next_pc
+                cpu.instruction_count = count
+                key = _state_key(cpu)
+                first = seen.get(key)
+                if first is not None and next_change(cpu) is None:
+                    period = count - first
+                    return Cycle(first, period, *_loop_range(cpu, period))
+                table.jumps += 1
+                if table.jumps % table.stride == 0:
+                    if len(seen) >= table.capacity:
+                        seen.clear()
+                        table.stride *= 2
+                    seen[key] = count
+            pc = next_pc
+        cpu.pc = pc
+        cpu.instruction_count = count
+        return None
+    finally:
+        cpu._port_readers = readers
@@ -0,0 +1,184 @@
+"""
+BatPU-2 Counted Loop Acceleration
+Finds counted loops, straight-line bodies ending in
+
+    ADI rX -1
+    BRH NE <head>
+
+whose other instructions are NOP, LDI, ADI, ADD, SUB and STR to RAM, and
+runs the remaining iterations of such a loop in one go.
+
+The body is executed symbolically once, every value being an affine
+function (mod 256) of the registers at the top of the iteration. A
+register the body writes must come out either as itself plus a step that
+is the same every iteration (an induction variable, like rX itself) or as a
+value that is (a reset, like an LDI). Each STR then writes an address and
+value that move by a fixed amount per iteration, so the whole loop is a few
+multiplications plus a memory fill, with registers, flags, memory and the
+instruction count left exactly as iterating would leave them.
+
+Acceleration starts at the back edge, after at least one real iteration,
+and falls back to iterating whenever a store would hit an I/O port.
+"""
+
+from cfg import program_cfg
+
+
+def _const(value):
+    return (value & 0xFF, {})
+
+
+def _add(a, b, sign=1):
+    # Sum (or difference) of two affine values (constant, {register: coefficient})
+    coefficients = dict(a[1])
+    for register, coefficient in b[1].items():
+        coefficient = (coefficients.get(register, 0) + sign * coefficient) & 0xFF
+        if coefficient:
+            coefficients[register] = coefficient
+        else:
+            coefficients.pop(register, None)
+    return ((a[0] + sign * b[0]) & 0xFF, coefficients)
+
+
+def _evaluate(value, registers):
+    constant, coefficients = value
+    for register, coefficient in coefficients.items():
+        constant += coefficient * registers[register]
+    return constant & 0xFF
+
+
+class Loop:
+    """A counted loop found by find_loops()"""
+
+    def __init__(self, head, branch, counter, steps, resets, stores):
+        self.head = head        # First instruction of the body
+        self.branch = branch    # The BRH NE back to head
+        self.counter = counter  # rX
+        self.length = branch - head + 1  # Instructions per iteration
+        self.steps = steps      # Register -> step per iteration
+        self.resets = resets    # Register -> value it is set to every iteration
+        self.stores = stores    # (address, value) of each STR, in order
+
+    def accelerate(self, cpu, max_instructions):
+        """Run the remaining iterations from the loop head, if possible"""
+        registers = cpu.registers
+        for register, value in self.resets.items():
+            if _evaluate(value, registers) != registers[register]:
+                return  # Entered sideways, not every reset has happened yet
+        counter = registers[self.counter]
+        iterations = min(counter or 256, (max_instructions - cpu.instruction_count) // self.length)
+        if iterations <= 0:
+            return
+
+        steps = {register: _evaluate(step, registers) for register, step in self.steps.items()}
+        writes = []
+        for address, value in self.stores:
+            # How far the address and value move per iteration
+            address_step = sum(c * steps.get(r, 0) for r, c in address[1].items()) & 0xFF
+            value_step = sum(c * steps.get(r, 0) for r, c in value[1].items()) & 0xFF
+            start = _evaluate(address, registers)
+            if any((start + i * address_step) & 0xFF >= 240
+                   for i in range(iterations if address_step else 1)):
+                return  # I/O, let it run
+            writes.append((start, address_step, _evaluate(value, registers), value_step))
+
+        memory = cpu.memory
+        if len(writes) == 1 and writes[0][1] == 1 and writes[0][3] == 0 and writes[0][0] + iterations <= 240:
+            start, _, value, _ = writes[0]
+            memory[start:start + iterations] = bytes((value,)) * iterations
+        else:
+            for i in range(iterations):
+                for start, address_step, value, value_step in writes:
+                    memory[(start + i * address_step) & 0xFF] = (value + i * value_step) & 0xFF
+
+        for register, step in steps.items():
+            registers[register] = (registers[register] + iterations * step) & 0xFF
+        # Flags of the last ADI rX -1
+        last = (counter - iterations + 1) & 0xFF
+        cpu.carry_flag = last == 0
+        cpu.zero_flag = last == 1
+        cpu.pc = self.branch + 1 if cpu.zero_flag else self.head
+        cpu.instruction_count += iterations * self.length
+
+
+def _loop(decoded, head, branch):
+    # The Loop for a BRH NE at branch, None if its body doesn't qualify
+    opcode, counter, _, _, imm = decoded[branch - 1]
+    if opcode != 9 or imm != -1 or counter == 0 or head >= branch:
+        return None
+    values = {register: (0, {register: 1}) for register in range(1, 16)}
+    values[0] = _const(0)
+    stores = []
+    for opcode, reg_a, reg_b, reg_c, imm in decoded[head:branch - 1]:
+        if opcode == 8:  # LDI
+            written, value = reg_a, _const(imm)
+        elif opcode == 9:  # ADI
+            written, value = reg_a, _add(values[reg_a], _const(imm))
+        elif opcode in (2, 3):  # ADD, SUB
+            written, value = reg_c, _add(values[reg_a], values[reg_b], 1 if opcode == 2 else -1)
+        elif opcode == 15:  # STR
+            stores.append((_add(values[reg_a], _const(imm)), values[reg_b]))
+            continue
+        elif opcode == 0:  # NOP
+            continue
+        else:
+            return None
+        if written:
+            values[written] = value
+    if values[counter] != (0, {counter: 1}):
+        return None  # The ADI must be the only write to rX
+    values[counter] = (0xFF, {counter: 1})
+
+    steps = {}
+    resets = {}
+    for register in range(1, 16):
+        constant, coefficients = values[register]
+        if coefficients == {register: 1} and not constant:
+            continue  # Not written
+        if coefficients.get(register) == 1:
+            steps[register] = (constant, {r: c for r, c in coefficients.items() if r != register})
+        elif register not in coefficients:
+            resets[register] = values[register]
+        else:
+            return None
+    # A step may use registers that stay put, not other induction variables
+    for step in list(steps.values()) + list(resets.values()):
+        if any(r in steps for r in step[1]):
+            return None
+    return Loop(head, branch, counter, steps, resets, stores)
+
+
+def find_loops(decoded, graph):
+    """Counted loops of a predecoded program and its cfg.CFG, as branch address -> Loop"""
+    loops = {}
+    for natural in graph.loops:
+        head = natural.header
+        for tail in natural.tails:
+            branch = graph.blocks[tail].last
+            opcode, condition, _, _, target = decoded[branch]
+            if opcode != 11 or condition != 1 or target != head or head >= branch:  # BRH NE backwards
+                continue
+            # The body must be straight-line code
+            if any(decoded[pc][0] in (1, 10, 11, 12, 13) for pc in range(head, branch)):
+                continue
+            loop = _loop(decoded, head, branch)
+            if loop is not None:
+                loops[branch] = loop
+    return loops
+
+
+def _trap(loop):
+    def trap(cpu, max_instructions):
+        cpu.execute_one()  # The BRH
+        if cpu.pc == loop.head and cpu.instruction_count < max_instructions:
+            loop.accelerate(cpu, max_instructions)
+        return True
+    return trap
+
+
+def traps(cpu):
+    """Traps for threaded.run_traps() on the back edges of the CPU's counted loops"""
+    loops = cpu._compiled.get('loops')
+    if loops is None:
+        loops = cpu._compiled['loops'] = find_loops(cpu._decoded, program_cfg(cpu))
+    return {branch: _trap(loop) for branch, loop in loops.items()}
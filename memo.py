@@ -0,0 +1,194 @@
+"""
+BatPU-2 Pure Subroutine Memoization
+A subroutine is pure when no code reachable from its entry touches RAM or
+I/O ports, calls anything or halts: what it does then only depends on the
+registers and flags it reads before writing them. find_pure() works those
+out for every call target (see cfg.CFG), along with the registers it may
+write.
+
+With cpu.memoize, each call of a pure subroutine is looked up in the
+program's memo table by those inputs. A hit sets the output registers and
+flags, adds the instruction count the call took and returns like RET. A
+miss runs the call through the interpreter and records the outcome. Tables
+are shared by every CPU running the same program, hold at most
+MEMO_CAPACITY entries and evict the least recently used one.
+"""
+
+from collections import OrderedDict
+from cfg import program_cfg
+
+MEMO_CAPACITY = 4096
+
+# Programs whose memo table is kept: program hash -> Memo
+MEMO_PROGRAMS = 16
+_tables = OrderedDict()
+
+
+def _effects(instruction):
+    # (registers and flags read, registers and flags written) by an instruction
+    opcode, reg_a, reg_b, reg_c, imm = instruction
+    if 2 <= opcode <= 6:  # ADD, SUB, NOR, AND, XOR
+        return {reg_a, reg_b}, ({reg_c, 'z', 'c'} if opcode <= 3 else {reg_c, 'z'})
+    if opcode == 7:  # RSH
+        return {reg_a}, {reg_c, 'z', 'c'}
+    if opcode == 8:  # LDI
+        return set(), {reg_a}
+    if opcode == 9:  # ADI
+        return {reg_a}, {reg_a, 'z', 'c'}
+    if opcode == 11:  # BRH
+        return {'z' if reg_a < 2 else 'c'}, set()
+    return set(), set()
+
+
+def _successors(decoded, pc):
+    # Where the instruction at pc can go, None if it isn't allowed in a pure routine
+    opcode, reg_a, reg_b, reg_c, imm = decoded[pc]
+    if opcode in (1, 12, 14, 15):  # HLT, CAL, LOD, STR
+        return None
+    if opcode == 10:  # JMP
+        return (imm,)
+    if opcode == 11:  # BRH
+        return (imm, pc + 1)
+    if opcode == 13:  # RET
+        return ()
+    return (pc + 1,)
+
+
+class PureRoutine:
+    """Inputs and outputs of a pure subroutine"""
+
+    def __init__(self, entry, registers, flags, outputs):
+        self.entry = entry
+        self.registers = registers  # Input registers, in key order
+        self.flags = flags          # Input flags: 'z', 'c'
+        self.outputs = outputs      # Registers it may write
+
+    def key(self, cpu):
+        registers = cpu.registers
+        return (self.entry, bytes(registers[r] for r in self.registers),
+                'z' in self.flags and cpu.zero_flag, 'c' in self.flags and cpu.carry_flag)
+
+
+def pure_routine(decoded, entry):
+    """The PureRoutine at entry, or None if the code reachable from it isn't pure"""
+    # Registers and flags written on every path to each instruction
+    written = {entry: frozenset()}
+    pending = [entry]
+    returns = []
+    while pending:
+        pc = pending.pop()
+        if pc >= len(decoded):
+            return None
+        successors = _successors(decoded, pc)
+        if successors is None:
+            return None
+        if not successors:
+            returns.append(pc)
+        out = written[pc] | _effects(decoded[pc])[1]
+        for successor in successors:
+            before = written.get(successor)
+            after = out if before is None else before & out
+            if after != before:
+                written[successor] = after
+                pending.append(successor)
+    if not returns:
+        return None
+
+    inputs = set()
+    outputs = set()
+    for pc, done in written.items():
+        reads, writes = _effects(decoded[pc])
+        inputs |= reads - done
+        outputs |= writes
+    outputs.discard(0)
+    # Whatever isn't written on every path comes back out unchanged, so it is an input too
+    for pc in returns:
+        inputs |= (outputs | {'z', 'c'}) - written[pc]
+    inputs.discard(0)
+    return PureRoutine(entry, tuple(sorted(r for r in inputs if r != 'z' and r != 'c')),
+                       frozenset(inputs & {'z', 'c'}), tuple(sorted(r for r in outputs if r not in ('z', 'c'))))
+
+
+def find_pure(decoded, entries):
+    """Pure subroutines among entries of a predecoded program, as entry address -> PureRoutine"""
+    found = {entry: pure_routine(decoded, entry) for entry in entries}
+    return {entry: routine for entry, routine in found.items() if routine is not None}
+
+
+class Memo:
+    """Bounded LRU table of pure subroutine calls for one program"""
+
+    def __init__(self, capacity=MEMO_CAPACITY):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key -> (output register values, z, c, instructions)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def report(self):
+        return (f"Memo: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+                f"{len(self.entries)} entries")
+
+    def call(self, cpu, routine, max_instructions):
+        """Trap for the routine's entry, see threaded.run_traps()"""
+        if not cpu.stack_depth:
+            return False  # Nowhere to return to
+        key = routine.key(cpu)
+        entry = self.entries.get(key)
+        if entry is not None:
+            values, zero, carry, instructions = entry
+            if cpu.instruction_count + instructions > max_instructions:
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            registers = cpu.registers
+            for register, value in zip(routine.outputs, values):
+                registers[register] = value
+            cpu.zero_flag = zero
+            cpu.carry_flag = carry
+            depth = cpu.stack_depth - 1
+            cpu.stack_depth = depth
+            cpu.pc = cpu.stack[depth]
+            cpu.instruction_count += instructions
+            return True
+
+        # Run the call, and remember it if it returns within the run
+        self.misses += 1
+        start = cpu.instruction_count
+        depth = cpu.stack_depth
+        while cpu.instruction_count < max_instructions and cpu.execute_one():
+            if cpu.stack_depth < depth:
+                registers = cpu.registers
+                self.entries[key] = (bytes(registers[r] for r in routine.outputs), cpu.zero_flag,
+                                     cpu.carry_flag, cpu.instruction_count - start)
+                if len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+                break
+        return True
+
+
+def table(cpu):
+    """The memo table of the CPU's program"""
+    memo = _tables.get(cpu.program_hash)
+    if memo is None:
+        if len(_tables) >= MEMO_PROGRAMS:
+            _tables.popitem(last=False)
+        memo = _tables[cpu.program_hash] = Memo()
+    else:
+        _tables.move_to_end(cpu.program_hash)
+    return memo
+
+
+def traps(cpu):
+    """Traps for threaded.run_traps() on the entries of the CPU's pure subroutines"""
+    routines = cpu._compiled.get('pure')
+    if routines is None:
+        routines = cpu._compiled['pure'] = find_pure(cpu._decoded, program_cfg(cpu).call_targets)
+    memo = table(cpu)
+    return {entry: (lambda cpu, max_instructions, routine=routine: memo.call(cpu, routine, max_instructions))
+            for entry, routine in routines.items()}
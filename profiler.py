@@ -0,0 +1,368 @@
+"""
+BatPU-2 Execution Profiler
+Counts how many times each program address executes, using its own copy of
+the interpreter loop so unprofiled runs pay nothing for it. CallGraphProfile
+also attributes instructions to subroutines by following CAL/RET, and
+AccessProfile counts LOD/STR accesses per RAM address and I/O port.
+
+    profile = Profile()                  # or CallGraphProfile()
+    cpu.run(1000000, profile=profile)
+    print(profile.report(cpu))
+    profile.save('out.callgrind', cpu)   # or out.json
+
+Program memory is never written at runtime, so per-opcode counts are derived
+from the per-address counts when a report is made.
+"""
+
+import json
+
+# Instruction address space (10-bit PC)
+PROGRAM_SIZE = 1024
+
+
+class Profile:
+    """Execution counts per program address"""
+
+    def __init__(self):
+        self.pc_counts = [0] * PROGRAM_SIZE
+
+    def clear(self):
+        self.pc_counts[:] = [0] * PROGRAM_SIZE
+
+    @property
+    def total(self):
+        """Instructions counted so far"""
+        return sum(self.pc_counts)
+
+    def opcode_counts(self, cpu):
+        """Execution counts per opcode, in opcode order"""
+        counts = [0] * 16
+        pc_counts = self.pc_counts
+        for pc, instruction in enumerate(cpu._decoded):
+            counts[instruction[0]] += pc_counts[pc]
+        return counts
+
+    def hot_spots(self):
+        """(address, count) pairs of executed addresses, hottest first"""
+        return sorted(((pc, n) for pc, n in enumerate(self.pc_counts) if n), key=lambda item: -item[1])
+
+    def report(self, cpu, top=20):
+        """Human readable hot-spot and opcode report"""
+        total = self.total or 1
+        lines = ["", f"  Profile: {self.total} instructions", "-"*60,
+                 f"  Hot spots (top {top}):"]
+        for pc, n in self.hot_spots()[:top]:
+            lines.append(f"  [{pc:4d}] {n:10d} {n * 100 / total:6.2f}%  {cpu.disassemble(cpu.program[pc])}")
+        lines.append("-"*60)
+        lines.append("  Opcodes:")
+        for opcode, n in sorted(enumerate(self.opcode_counts(cpu)), key=lambda item: -item[1]):
+            if n:
+                lines.append(f"  {cpu.opcodes[opcode].upper():4s} {n:10d} {n * 100 / total:6.2f}%")
+        return "\n".join(lines)
+
+    def to_dict(self, cpu):
+        """Machine-readable profile, see save()"""
+        return {
+            'program': cpu.program_hash,
+            'instructions': self.total,
+            'pc': [{'addr': pc, 'count': n, 'text': cpu.disassemble(cpu.program[pc])}
+                   for pc, n in self.hot_spots()],
+            'opcodes': {cpu.opcodes[opcode]: n for opcode, n in enumerate(self.opcode_counts(cpu))},
+        }
+
+    def callgrind(self, cpu):
+        """Profile in callgrind format, one cost line per executed address"""
+        lines = ["# callgrind format", "version: 1", "creator: batpu2-profiler",
+                 "positions: instr", "events: Instructions", f"summary: {self.total}",
+                 "", f"ob=batpu2 {cpu.program_hash[:12]}", "fn=program"]
+        for pc, n in enumerate(self.pc_counts):
+            if n:
+                lines.append(f"{pc:#x} {n}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename, cpu):
+        """Write the profile as JSON (.json) or in callgrind format (anything else)"""
+        with open(filename, 'w') as f:
+            if filename.endswith('.json'):
+                json.dump(self.to_dict(cpu), f, indent=2)
+            else:
+                f.write(self.callgrind(cpu))
+
+    def run(self, cpu, max_instructions):
+        """Interpreter loop counting every executed address in pc_counts"""
+        # _run_interpreter plus one counter update
+        decoded = cpu._decoded
+        dispatch = cpu._dispatch
+        counts = self.pc_counts
+        program_length = len(decoded)
+        while cpu.instruction_count < max_instructions:
+            pc = cpu.pc
+            if cpu.halted or pc >= program_length:
+                cpu.halted = True
+                break
+            opcode, reg_a, reg_b, reg_c, imm = decoded[pc]
+            next_pc = dispatch[opcode](reg_a, reg_b, reg_c, imm)
+            if next_pc is None:
+                break
+            counts[pc] += 1
+            cpu.pc = next_pc
+            cpu.instruction_count += 1
+
+
+# Entry of the code running outside any subroutine
+ROOT = None
+# Entry of frames that were already on the stack when profiling started
+UNKNOWN = '?'
+
+
+def function_name(cpu, entry):
+    """Name of the subroutine starting at entry: its label, or sub_<address>"""
+    if entry is ROOT:
+        return 'main'
+    if entry == UNKNOWN:
+        return UNKNOWN
+    for name, address in cpu.labels.items():
+        if address == entry:
+            return name
+    return f'sub_{entry}'
+
+
+class CallGraphProfile(Profile):
+    """Profile that also follows the call stack through CAL/RET
+
+    Instructions are attributed to the subroutine (CAL target) they run in,
+    exclusive, and to every subroutine on the stack, inclusive. The CAL
+    belongs to the caller and the RET to the callee. Bookkeeping only happens
+    when the stack depth changes, the per-instruction cost is a counter.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.clear()
+
+    def clear(self):
+        super().clear()
+        self.clock = 0         # Instructions seen
+        self.frames = []       # Shadow call stack: (entry, clock at entry)
+        self.path = ()         # Entries on the stack, outermost first
+        self.path_start = 0    # Clock when the stack last changed
+        self.stacks = {}       # Stack path -> exclusive instructions
+        self.inclusive = {}    # Entry -> inclusive instructions, finished calls
+        self.active = {}       # Entry -> frames on the stack (recursion)
+        self.calls = {}        # (caller, callee) -> number of calls
+        self.call_costs = {}   # (caller, callee) -> inclusive instructions, finished calls
+
+    def _flush(self):
+        self.stacks[self.path] = self.stacks.get(self.path, 0) + self.clock - self.path_start
+        self.path_start = self.clock
+
+    def _enter(self, entry):
+        self._flush()
+        caller = self.frames[-1][0] if self.frames else ROOT
+        self.calls[caller, entry] = self.calls.get((caller, entry), 0) + 1
+        self.active[entry] = self.active.get(entry, 0) + 1
+        self.frames.append((entry, self.clock))
+        self.path += (entry,)
+
+    def _leave(self):
+        self._flush()
+        entry, start = self.frames.pop()
+        caller = self.frames[-1][0] if self.frames else ROOT
+        self.call_costs[caller, entry] = self.call_costs.get((caller, entry), 0) + self.clock - start
+        self.active[entry] -= 1
+        if not self.active[entry]:
+            # Recursive calls are already inside the outermost one
+            self.inclusive[entry] = self.inclusive.get(entry, 0) + self.clock - start
+        self.path = self.path[:-1]
+
+    def run(self, cpu, max_instructions):
+        """Interpreter loop counting addresses and following the call stack"""
+        if len(self.frames) != cpu.stack_depth:
+            # Started with frames we did not see being entered (restore, boot)
+            while self.frames:
+                self._leave()
+            for _ in range(cpu.stack_depth):
+                self._enter(UNKNOWN)
+        decoded = cpu._decoded
+        dispatch = cpu._dispatch
+        counts = self.pc_counts
+        program_length = len(decoded)
+        depth = cpu.stack_depth
+        clock = self.clock
+        while cpu.instruction_count < max_instructions:
+            pc = cpu.pc
+            if cpu.halted or pc >= program_length:
+                cpu.halted = True
+                break
+            opcode, reg_a, reg_b, reg_c, imm = decoded[pc]
+            next_pc = dispatch[opcode](reg_a, reg_b, reg_c, imm)
+            if next_pc is None:
+                break
+            counts[pc] += 1
+            clock += 1
+            cpu.pc = next_pc
+            cpu.instruction_count += 1
+            if cpu.stack_depth != depth:
+                self.clock = clock
+                if cpu.stack_depth > depth:
+                    self._enter(imm)  # CAL target
+                else:
+                    self._leave()
+                depth = cpu.stack_depth
+        self.clock = clock
+
+    def stack_counts(self):
+        """Stack path -> exclusive instructions, including the running call"""
+        stacks = dict(self.stacks)
+        stacks[self.path] = stacks.get(self.path, 0) + self.clock - self.path_start
+        return {path: n for path, n in stacks.items() if n}
+
+    def functions(self):
+        """Entry -> (calls, inclusive, exclusive) instructions, including running calls"""
+        exclusive = {ROOT: 0}
+        for path, n in self.stack_counts().items():
+            entry = path[-1] if path else ROOT
+            exclusive[entry] = exclusive.get(entry, 0) + n
+        inclusive = dict(self.inclusive)
+        inclusive[ROOT] = self.clock
+        seen = set()
+        for entry, start in self.frames:
+            if entry not in seen:
+                seen.add(entry)
+                inclusive[entry] = inclusive.get(entry, 0) + self.clock - start
+        calls = {}
+        for (caller, callee), n in self.calls.items():
+            calls[callee] = calls.get(callee, 0) + n
+        return {entry: (calls.get(entry, 0), inclusive.get(entry, 0), exclusive.get(entry, 0))
+                for entry in exclusive.keys() | inclusive.keys()}
+
+    def report(self, cpu, top=20):
+        """Hot spots, opcodes and per-subroutine inclusive/exclusive counts"""
+        total = self.clock or 1
+        lines = [super().report(cpu, top), "-"*60,
+                 f"  {'Subroutine':20s} {'Calls':>8s} {'Inclusive':>16s} {'Exclusive':>16s}"]
+        functions = sorted(self.functions().items(), key=lambda item: -item[1][1])
+        for entry, (calls, inclusive, exclusive) in functions[:top]:
+            lines.append(f"  {function_name(cpu, entry):20s} {calls:8d} {inclusive:9d} {inclusive * 100 / total:5.1f}%"
+                         f" {exclusive:9d} {exclusive * 100 / total:5.1f}%")
+        return "\n".join(lines)
+
+    def collapsed(self, cpu):
+        """Collapsed stacks ("main;caller;callee count" lines) for flame graph tools"""
+        lines = []
+        for path, n in self.stack_counts().items():
+            names = ['main'] + [function_name(cpu, entry) for entry in path]
+            lines.append(f"{';'.join(names)} {n}")
+        return "\n".join(sorted(lines)) + "\n"
+
+    def to_dict(self, cpu):
+        data = super().to_dict(cpu)
+        data['functions'] = [
+            {'name': function_name(cpu, entry), 'entry': entry,
+             'calls': calls, 'inclusive': inclusive, 'exclusive': exclusive}
+            for entry, (calls, inclusive, exclusive) in self.functions().items()]
+        return data
+
+    def callgrind(self, cpu):
+        """Call graph in callgrind format: exclusive cost per subroutine, inclusive per call"""
+        lines = ["# callgrind format", "version: 1", "creator: batpu2-profiler",
+                 "positions: instr", "events: Instructions", f"summary: {self.clock}",
+                 "", f"ob=batpu2 {cpu.program_hash[:12]}"]
+        functions = self.functions()
+        for entry, (calls, inclusive, exclusive) in functions.items():
+            address = entry if isinstance(entry, int) else 0  # main and unknown frames
+            lines.append(f"fn={function_name(cpu, entry)}")
+            lines.append(f"{address:#x} {exclusive}")
+            for (caller, callee), n in self.calls.items():
+                if caller == entry:
+                    target = callee if isinstance(callee, int) else 0
+                    lines.append(f"cfn={function_name(cpu, callee)}")
+                    lines.append(f"calls={n} {target:#x}")
+                    lines.append(f"{address:#x} {self.call_costs.get((caller, callee), 0)}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename, cpu):
+        """Write the profile as JSON (.json), collapsed stacks (.folded) or callgrind"""
+        if filename.endswith('.folded'):
+            with open(filename, 'w') as f:
+                f.write(self.collapsed(cpu))
+        else:
+            super().save(filename, cpu)
+
+
+class AccessProfile:
+    """LOD/STR counts per data address: RAM 0-239 and I/O ports 240-255
+
+    Runs the interpreter loop with counting LOD and STR handlers, the other
+    instructions run as usual.
+    """
+
+    def __init__(self):
+        self.reads = [0] * 256
+        self.writes = [0] * 256
+
+    def clear(self):
+        self.reads[:] = [0] * 256
+        self.writes[:] = [0] * 256
+
+    def ports(self, cpu):
+        """Port name -> (reads, writes) for the ports that were accessed"""
+        return {name: (self.reads[240 + i], self.writes[240 + i]) for i, name in enumerate(cpu.ports)
+                if self.reads[240 + i] or self.writes[240 + i]}
+
+    def report(self, cpu, top=20):
+        """Hottest RAM addresses and I/O port usage"""
+        ram = sorted((address for address in range(240) if self.reads[address] or self.writes[address]),
+                     key=lambda address: -(self.reads[address] + self.writes[address]))
+        lines = ["", f"  Memory accesses: {sum(self.reads)} reads, {sum(self.writes)} writes", "-"*60,
+                 f"  Hot RAM (top {top}):"]
+        for address in ram[:top]:
+            lines.append(f"  [{address:3d}] {self.reads[address]:10d} R {self.writes[address]:10d} W")
+        lines.append("-"*60)
+        lines.append("  I/O ports:")
+        for name, (reads, writes) in self.ports(cpu).items():
+            lines.append(f"  {name:20s} {reads:10d} R {writes:10d} W")
+        return "\n".join(lines)
+
+    def to_dict(self, cpu):
+        return {
+            'program': cpu.program_hash,
+            'reads': self.reads,
+            'writes': self.writes,
+            'ports': {name: {'reads': reads, 'writes': writes} for name, (reads, writes) in self.ports(cpu).items()},
+        }
+
+    def save(self, filename, cpu):
+        """Write the counts as JSON"""
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(cpu), f, indent=2)
+
+    def run(self, cpu, max_instructions):
+        """Interpreter loop counting LOD/STR addresses"""
+        reads = self.reads
+        writes = self.writes
+        registers = cpu.registers
+        op_lod = cpu._op_lod
+        op_str = cpu._op_str
+
+        def lod(reg_a, reg_b, reg_c, imm):
+            reads[(registers[reg_a] + imm) & 0xFF] += 1
+            return op_lod(reg_a, reg_b, reg_c, imm)
+
+        def store(reg_a, reg_b, reg_c, imm):
+            writes[(registers[reg_a] + imm) & 0xFF] += 1
+            return op_str(reg_a, reg_b, reg_c, imm)
+
+        decoded = cpu._decoded
+        dispatch = cpu._dispatch[:14] + [lod, store]
+        program_length = len(decoded)
+        while cpu.instruction_count < max_instructions:
+            if cpu.halted or cpu.pc >= program_length:
+                cpu.halted = True
+                break
+            opcode, reg_a, reg_b, reg_c, imm = decoded[cpu.pc]
+            next_pc = dispatch[opcode](reg_a, reg_b, reg_c, imm)
+            if next_pc is None:
+                break
+            cpu.pc = next_pc
+            cpu.instruction_count += 1
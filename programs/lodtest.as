@@ -0,0 +1,17 @@
+; Test de LOD (régression)
+; LOD A B offset charge B depuis Mem[A + offset], comme STR A B offset
+; écrit B dans Mem[A + offset]. Résultat attendu : r3 = 42, r4 = 7,
+; r1 inchangé (10), et 42 sur l'afficheur de nombres.
+
+ldi r1 10       ; Adresse
+ldi r2 42
+str r1 r2       ; Mem[10] = 42
+ldi r2 7
+str r1 r2 1     ; Mem[11] = 7
+
+lod r1 r3       ; r3 = Mem[10] = 42
+lod r1 r4 1     ; r4 = Mem[11] = 7
+
+ldi r15 show_number
+str r15 r3      ; Affiche 42
+hlt
@@ -15,6 +15,6 @@ str r5 r3       ; Mem[2] = CC
 
 ; Lire depuis la mémoire pour vérifier (r10 devrait devenir AA)
 ldi r5 0
-lod r10 r5      ; r10 = Mem[0]
+lod r5 r10      ; r10 = Mem[0]
 
 hlt
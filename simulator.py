@@ -6,21 +6,188 @@ Simulates the execution of BatPU-2 machine code (.mc files) or assembly (.as fil
 
 import sys
 from assembler import assemble
+from translator import run_aot, run_tiered, DEFAULT_CACHE_DIR
+from threaded import run_threaded, load_handlers, patch_handlers, run_traps
+from controller import InputTimeline
+from history import History
+from profiler import Profile, CallGraphProfile, AccessProfile
+from breakpoints import Breakpoints, run_debug
+from idle import run_idle, find_cycle, never, Cycle
+import hle
+import loops
+import memo
+import hashlib
+import random
+import struct
 import tempfile
 import os
 
+# Call stack depth of the hardware
+STACK_SIZE = 16
+
+# Screen size, the framebuffer packs each 32 pixel row into 4 bytes
+SCREEN_SIZE = 32
+ROW_BYTES = SCREEN_SIZE // 8
+
+
+def _splitmix64(x):
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+
+# I/O ports 240-255, in port order
+PORTS = ('pixel_x', 'pixel_y', 'draw_pixel', 'clear_pixel', 'load_pixel', 'buffer_screen',
+         'clear_screen_buffer', 'write_char', 'buffer_chars', 'clear_chars_buffer', 'show_number',
+         'clear_number', 'signed_mode', 'unsigned_mode', 'rng', 'controller_input')
+
+
+def port_index(port):
+    """Return the 0-15 device index of a port given as 240-255 or by name"""
+    if isinstance(port, str):
+        return PORTS.index(port)
+    if not 240 <= port <= 255:
+        raise ValueError(f"Not an I/O port: {port} (ports are 240-255)")
+    return port - 240
+
+
+# Character display width
+CHAR_DISPLAY_SIZE = 10
+
+# write_char value -> ASCII code: 0-29 are the BatPU-2 character set, printable
+# ASCII is accepted as a fallback and anything else shows as '?'
+CHAR_SET = ' abcdefghijklmnopqrstuvwxyz.!?'
+CHAR_CODES = bytes(ord(CHAR_SET[v]) if v < len(CHAR_SET) else v if 32 <= v <= 126 else ord('?')
+                   for v in range(256))
+
+# Zobrist keys for the frame hash: the hash of a frame is the XOR of the keys
+# of its lit pixels, so it is updated in O(1) per pixel change and is stable
+# across runs and processes. An empty screen hashes to 0.
+PIXEL_KEYS = tuple(_splitmix64(i) for i in range(SCREEN_SIZE * SCREEN_SIZE))
+
+
+# Save-state blob written by BatPU2.snapshot(). Multi-byte fields are little
+# endian. The program itself is not included, only a digest prefix that
+# restore() checks against the loaded program.
+SNAPSHOT_MAGIC = b'BPU2'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FORMAT = struct.Struct(
+    '<4sB16s'     # magic, version, program digest prefix
+    'HBB'         # pc, flags (see SNAPSHOT_* bits), call stack depth
+    'QQ'          # instruction count, frame count
+    'BBBBh'       # pixel x/y, pending char count, shown char count, number display
+    'IIQ'         # rng state, rng stream position, rng seed
+    '16s256s16H'  # registers, memory, call stack
+    '128sQ128sQ'  # draw buffer + hash, displayed frame + hash
+    '10s10s'      # pending chars, shown chars
+)
+SNAPSHOT_ZERO, SNAPSHOT_CARRY, SNAPSHOT_HALTED, SNAPSHOT_SIGNED, SNAPSHOT_CHARS, SNAPSHOT_NUMBER = (
+    1 << i for i in range(6))
+
+
+# Longest program prologue boot_state() runs, in instructions
+BOOT_LIMIT = 1000000
+
+# Bump when instruction or device semantics change, so boot states cached
+# on disk by older versions are computed again
+BOOT_VERSION = 1
+
+# Boot states shared between instances: program hash -> snapshot
+_boot_states = {}
+
+
+def predecode(instruction):
+    """Decode a 16-bit instruction into a compact (opcode, a, b, c, imm) tuple
+
+    Only the fields the opcode actually uses are filled in, the rest are 0:
+      ADD/SUB/NOR/AND/XOR/RSH: a, b, c = reg A, reg B, reg C
+      LDI/ADI:                 a = reg A, imm = imm8 (sign-extended for ADI)
+      JMP/CAL:                 imm = imm10
+      BRH:                     a = condition, imm = imm10
+      LOD/STR:                 a, b = reg A, reg B, imm = sign-extended offset
+    """
+    opcode = (instruction >> 12) & 0xF
+    if 2 <= opcode <= 7:
+        return (opcode, (instruction >> 8) & 0xF, (instruction >> 4) & 0xF, instruction & 0xF, 0)
+    if opcode == 8:
+        return (opcode, (instruction >> 8) & 0xF, 0, 0, instruction & 0xFF)
+    if opcode == 9:
+        imm8 = instruction & 0xFF
+        return (opcode, (instruction >> 8) & 0xF, 0, 0, imm8 if imm8 < 128 else imm8 - 256)
+    if opcode in (10, 12):
+        return (opcode, 0, 0, 0, instruction & 0x3FF)
+    if opcode == 11:
+        return (opcode, (instruction >> 10) & 0x3, 0, 0, instruction & 0x3FF)
+    if opcode >= 14:
+        offset = instruction & 0xF
+        return (opcode, (instruction >> 8) & 0xF, (instruction >> 4) & 0xF, 0, offset if offset < 8 else offset - 16)
+    return (opcode, 0, 0, 0, 0)
+
+
+# BRH conditions, indexed by the 2-bit condition field
+BRANCH_CONDITIONS = (
+    lambda cpu: cpu.zero_flag,       # EQ/Z
+    lambda cpu: not cpu.zero_flag,   # NE/NZ
+    lambda cpu: cpu.carry_flag,      # GE/C
+    lambda cpu: not cpu.carry_flag,  # LT/NC
+)
+
+
+def program_digest(program):
+    """Stable hash of a program's instruction words"""
+    return hashlib.sha256(b''.join(w.to_bytes(2, 'big') for w in program)).hexdigest()
+
+
+# Loaded program images shared between instances: hash -> (words, decoded)
+_program_images = {}
+PROGRAM_IMAGE_CACHE_SIZE = 64
+
+
+def program_image(words):
+    """Return (hash, words tuple, predecoded list) for a program, shared between CPUs"""
+    words = tuple(words)
+    digest = program_digest(words)
+    image = _program_images.get(digest)
+    if image is None:
+        if len(_program_images) >= PROGRAM_IMAGE_CACHE_SIZE:
+            del _program_images[next(iter(_program_images))]
+        image = _program_images[digest] = (words, [predecode(w) for w in words])
+    return digest, image[0], image[1]
+
+
 class BatPU2:
     """BatPU-2 CPU Emulator"""
     
-    def __init__(self):
+    __slots__ = ('registers', 'memory', '_program', '_decoded', 'program_hash', '_compiled',
+                 'engine', 'pc', 'zero_flag', 'carry_flag', 'stack', 'stack_depth', 'halted',
+                 'instruction_count', 'framebuffer', 'frame_hash', 'display', 'display_hash',
+                 'frame_count', 'frame_listeners', 'pixel_x', 'pixel_y', 'char_buffer', 'char_count',
+                 'char_display', 'rng_seed', 'rng_state', 'rng_stream', 'rng_pos',
+                 '_port_readers', '_port_writers',
+                 'number_display', 'signed_mode', 'breakpoints', 'fast_forward', 'idle_skipped', 'cycle_check',
+                 'hle', 'hle_verify', 'accelerate_loops', 'memoize',
+                 'labels', '_dispatch')
+    
+    # Opcodes
+    opcodes = ('nop', 'hlt', 'add', 'sub', 'nor', 'and', 'xor', 'rsh',
+               'ldi', 'adi', 'jmp', 'brh', 'cal', 'ret', 'lod', 'str')
+    
+    # I/O port names, port 240 first
+    ports = PORTS
+    
+    def __init__(self, seed=None):
         # 16 general purpose registers (r0-r15), r0 is always 0
-        self.registers = [0] * 16
+        self.registers = bytearray(16)
         
         # 256 bytes of data memory
-        self.memory = [0] * 256
+        self.memory = bytearray(256)
+        
+        # 1024 instructions max, predecoded when assigned
+        self.program = ()
         
-        # 1024 instructions max
-        self.program = []
+        # Execution engine used by run(), see ENGINES
+        self.engine = 'interp'
         
         # Program counter (10 bits, 0-1023)
         self.pc = 0
@@ -29,8 +196,9 @@ class BatPU2:
         self.zero_flag = False
         self.carry_flag = False
         
-        # Call stack (16 levels max)
-        self.call_stack = []
+        # Call stack (16 levels max), stack[:stack_depth] are the live entries
+        self.stack = [0] * STACK_SIZE
+        self.stack_depth = 0
         
         # Halted state
         self.halted = False
@@ -38,47 +206,287 @@ class BatPU2:
         # Instruction count
         self.instruction_count = 0
         
-        # Screen buffer (32x32 pixels)
-        self.screen = [[0] * 32 for _ in range(32)]
+        # Screen buffer (32x32 pixels), one bit per pixel, see get_pixel().
+        # Programs draw into framebuffer and buffer_screen publishes it to
+        # display as a completed frame.
+        self.framebuffer = bytearray(SCREEN_SIZE * ROW_BYTES)
+        self.frame_hash = 0
+        self.display = bytearray(SCREEN_SIZE * ROW_BYTES)
+        self.display_hash = 0
+        self.frame_count = 0
+        
+        # Callables run with the CPU each time a frame is published
+        self.frame_listeners = []
         self.pixel_x = 0
         self.pixel_y = 0
         
-        # Character buffer
-        self.char_buffer = []
+        # Character buffer: write_char fills char_buffer[:char_count] (extra
+        # characters are dropped) and buffer_chars publishes it to char_display
+        self.char_buffer = bytearray(CHAR_DISPLAY_SIZE)
+        self.char_count = 0
+        self.char_display = None
         
         # Number display
         self.number_display = None
         self.signed_mode = False
         
-        # Opcodes
-        self.opcodes = ['nop', 'hlt', 'add', 'sub', 'nor', 'and', 'xor', 'rsh', 
-                        'ldi', 'adi', 'jmp', 'brh', 'cal', 'ret', 'lod', 'str']
+        # Random number generator behind the rng port: a seeded xorshift32,
+        # optionally preceded by a fixed byte stream (see set_rng_stream)
+        self.rng_stream = b''
+        self.seed_rng(seed)
+        
+        # I/O device handlers, indexed by port - 240. They start out as the
+        # shared default tables and are copied on the first attach_device()
+        self._port_readers = DEFAULT_PORT_READERS
+        self._port_writers = DEFAULT_PORT_WRITERS
+        
+        # Breakpoints and watchpoints, honoured by run() and advance()
+        self.breakpoints = Breakpoints()
+        
+        # Skip idle controller polling loops in run() and advance() (see
+        # idle.py), idle_skipped counts the instructions skipped so far
+        self.fast_forward = False
+        self.idle_skipped = 0
+        
+        # Stop runs in provably infinite loops (see idle.find_cycle()),
+        # instead of fast-forwarding them
+        self.cycle_check = False
+        
+        # Run native implementations of recognised subroutines (see hle.py),
+        # or with hle_verify check each call against the interpreter
+        self.hle = False
+        self.hle_verify = False
+        
+        # Run counted loops in closed form (see loops.py)
+        self.accelerate_loops = False
+        
+        # Skip repeat calls of pure subroutines (see memo.py)
+        self.memoize = False
+        
+        # Opcode handlers, in opcode order
+        self._dispatch = [self._op_nop, self._op_hlt, self._op_add, self._op_sub,
+                          self._op_nor, self._op_and, self._op_xor, self._op_rsh,
+                          self._op_ldi, self._op_adi, self._op_jmp, self._op_brh,
+                          self._op_cal, self._op_ret, self._op_lod, self._op_str]
+    
+    @property
+    def program(self):
+        """Program memory as a tuple of 16-bit words"""
+        return self._program
+    
+    @program.setter
+    def program(self, words):
+        # Program memory is never written at runtime, so decode it once here.
+        # The image is shared by every CPU running the same program.
+        self.program_hash, self._program, self._decoded = program_image(words)
+        # Per-engine translations of the current program
+        self._compiled = {}
+        # Assembler labels (name -> address), when the program came from a .as file
+        self.labels = {}
+    
+    @property
+    def call_stack(self):
+        """Live call stack entries, oldest first"""
+        return self.stack[:self.stack_depth]
+    
+    def _shown(self):
+        # Until a program publishes its first frame the screen shows the
+        # draw buffer directly, so programs that never use buffer_screen
+        # still display something
+        if self.frame_count:
+            return self.display, self.display_hash
+        return self.framebuffer, self.frame_hash
+    
+    @property
+    def screen(self):
+        """Displayed screen as 32 rows of 32 pixels (0 or 1)"""
+        buffer = self._shown()[0]
+        return [[(buffer[y * ROW_BYTES + (x >> 3)] >> (x & 7)) & 1 for x in range(SCREEN_SIZE)]
+                for y in range(SCREEN_SIZE)]
+    
+    @property
+    def screen_hash(self):
+        """Frame hash of the displayed screen"""
+        return self._shown()[1]
+    
+    def screen_view(self):
+        """Zero-copy, read-only view of the displayed 128 byte frame"""
+        return memoryview(self._shown()[0]).toreadonly()
+    
+    def get_pixel(self, x, y):
+        """Return pixel (x, y) of the draw buffer as 0 or 1"""
+        return (self.framebuffer[y * ROW_BYTES + (x >> 3)] >> (x & 7)) & 1
+    
+    def set_pixel(self, x, y, value):
+        """Light or clear pixel (x, y) of the draw buffer, keeping frame_hash up to date"""
+        index = y * ROW_BYTES + (x >> 3)
+        bit = 1 << (x & 7)
+        byte = self.framebuffer[index]
+        if bool(byte & bit) != bool(value):
+            self.framebuffer[index] = byte ^ bit
+            self.frame_hash ^= PIXEL_KEYS[y * SCREEN_SIZE + x]
+    
+    def buffer_screen(self):
+        """Publish the draw buffer as a completed frame and notify frame listeners"""
+        self.display[:] = self.framebuffer
+        self.display_hash = self.frame_hash
+        self.frame_count += 1
+        for listener in self.frame_listeners:
+            listener(self)
+    
+    def clear_screen_buffer(self):
+        """Clear the draw buffer, the displayed frame is unaffected"""
+        self.framebuffer[:] = bytes(len(self.framebuffer))
+        self.frame_hash = 0
+    
+    @property
+    def chars(self):
+        """Displayed characters, the pending buffer until the first buffer_chars"""
+        if self.char_display is None:
+            return self.pending_chars
+        return self.char_display
+    
+    @property
+    def pending_chars(self):
+        """Characters written since the last clear_chars_buffer"""
+        return self.char_buffer[:self.char_count].decode('ascii')
+    
+    def seed_rng(self, seed=None):
+        """Seed the rng port, a random seed is picked (and kept in rng_seed) if None"""
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.rng_seed = seed & 0xFFFFFFFFFFFFFFFF  # 64-bit seeds
+        self.rng_state = (_splitmix64(seed) & 0xFFFFFFFF) or 1  # xorshift state must be non-zero
+        self.rng_pos = 0
+    
+    def set_rng_stream(self, data):
+        """Serve these bytes from the rng port first, then continue with the generator"""
+        self.rng_stream = bytes(data)
+        self.rng_pos = 0
     
     def reset(self):
         """Reset the CPU to initial state"""
-        self.registers = [0] * 16
-        self.memory = [0] * 256
+        # Cleared in place, engines keep references to these buffers
+        self.registers[:] = bytes(16)
+        self.memory[:] = bytes(256)
         self.pc = 0
         self.zero_flag = False
         self.carry_flag = False
-        self.call_stack = []
+        self.stack_depth = 0
         self.halted = False
         self.instruction_count = 0
-        self.screen = [[0] * 32 for _ in range(32)]
+        self.framebuffer[:] = bytes(len(self.framebuffer))
+        self.frame_hash = 0
+        self.display[:] = bytes(len(self.display))
+        self.display_hash = 0
+        self.frame_count = 0
         self.pixel_x = 0
         self.pixel_y = 0
-        self.char_buffer = []
+        self.char_count = 0
+        self.char_display = None
         self.number_display = None
         self.signed_mode = False
+        self.idle_skipped = 0
+        # Replays the same random numbers, so a reset run is reproducible
+        self.seed_rng(self.rng_seed)
+    
+    def snapshot(self):
+        """Return the machine state as a compact bytes blob, see restore()
+        
+        Covers everything a program can observe: PC, flags, registers, RAM,
+        call stack, pixel cursor, both screen buffers, char and number
+        displays and the RNG position. Breakpoints, attached devices and the
+        RNG byte stream belong to the host and are left out.
+        """
+        flags = ((SNAPSHOT_ZERO if self.zero_flag else 0) | (SNAPSHOT_CARRY if self.carry_flag else 0)
+                 | (SNAPSHOT_HALTED if self.halted else 0) | (SNAPSHOT_SIGNED if self.signed_mode else 0)
+                 | (SNAPSHOT_CHARS if self.char_display is not None else 0)
+                 | (SNAPSHOT_NUMBER if self.number_display is not None else 0))
+        chars = (self.char_display or '').encode('ascii')
+        return SNAPSHOT_FORMAT.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, bytes.fromhex(self.program_hash[:32]),
+            self.pc, flags, self.stack_depth,
+            self.instruction_count, self.frame_count,
+            self.pixel_x, self.pixel_y, self.char_count, len(chars), self.number_display or 0,
+            self.rng_state, self.rng_pos, self.rng_seed,
+            bytes(self.registers), bytes(self.memory), *self.stack,
+            bytes(self.framebuffer), self.frame_hash, bytes(self.display), self.display_hash,
+            bytes(self.char_buffer), chars)
+    
+    def restore(self, blob):
+        """Restore a state returned by snapshot(), the same program must be loaded"""
+        if len(blob) != SNAPSHOT_FORMAT.size or blob[:4] != SNAPSHOT_MAGIC:
+            raise ValueError("Not a BatPU-2 snapshot")
+        (_, version, program, pc, flags, stack_depth,
+         instruction_count, frame_count,
+         pixel_x, pixel_y, char_count, chars_length, number,
+         rng_state, rng_pos, rng_seed,
+         registers, memory, *stack,
+         framebuffer, frame_hash, display, display_hash,
+         char_buffer, chars) = SNAPSHOT_FORMAT.unpack(blob)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {version}")
+        if program.hex() != self.program_hash[:32]:
+            raise ValueError("Snapshot was taken with a different program")
+        # Checked before anything is changed, the engines index with these
+        # and never write r0
+        if stack_depth > STACK_SIZE or char_count > CHAR_DISPLAY_SIZE or chars_length > CHAR_DISPLAY_SIZE:
+            raise ValueError("Corrupt snapshot: call stack or character display out of range")
+        # Jumps reach 1023 at most and execution stops on the word after the
+        # program, so a PC past both can't come from a real run
+        if pc > max(len(self._program), 1024):
+            raise ValueError(f"Corrupt snapshot: pc {pc} is outside the program address space")
+        if registers[0]:
+            raise ValueError("Corrupt snapshot: r0 is not 0")
+        self.pc, self.stack_depth = pc, stack_depth
+        self.instruction_count, self.frame_count = instruction_count, frame_count
+        self.pixel_x, self.pixel_y, self.char_count = pixel_x, pixel_y, char_count
+        self.rng_state, self.rng_pos, self.rng_seed = rng_state, rng_pos, rng_seed
+        self.frame_hash, self.display_hash = frame_hash, display_hash
+        # Copied in place, engines keep references to these buffers
+        self.registers[:] = registers
+        self.memory[:] = memory
+        self.stack[:] = stack
+        self.framebuffer[:] = framebuffer
+        self.display[:] = display
+        self.char_buffer[:] = char_buffer
+        self.zero_flag = bool(flags & SNAPSHOT_ZERO)
+        self.carry_flag = bool(flags & SNAPSHOT_CARRY)
+        self.halted = bool(flags & SNAPSHOT_HALTED)
+        self.signed_mode = bool(flags & SNAPSHOT_SIGNED)
+        self.char_display = chars[:chars_length].decode('ascii') if flags & SNAPSHOT_CHARS else None
+        self.number_display = number if flags & SNAPSHOT_NUMBER else None
+    
+    def boot(self, max_instructions=BOOT_LIMIT):
+        """Skip the program's deterministic prologue, returns True if it did
+        
+        Meant to be called right after reset(). Jumps to the state the program
+        reaches just before its first rng or controller_input read or its
+        first visible frame (see boot_state()), keeping this CPU's RNG seed.
+        Nothing is skipped when the prologue is longer than max_instructions,
+        or when custom devices or frame listeners could observe it.
+        """
+        if (not self._program or self.instruction_count or self.frame_listeners
+                or self._port_writers is not DEFAULT_PORT_WRITERS
+                or tuple(self._port_readers[:14]) != DEFAULT_PORT_READERS[:14]):
+            return False
+        state = boot_state(self.program_hash, self._program)
+        if SNAPSHOT_FORMAT.unpack(state)[6] > max_instructions:  # instruction count
+            return False
+        rng = self.rng_seed, self.rng_state, self.rng_pos
+        self.restore(state)
+        self.rng_seed, self.rng_state, self.rng_pos = rng
+        return True
     
     def load_mc(self, filename):
         """Load machine code from .mc file"""
-        self.program = []
+        program = []
         with open(filename, 'r') as f:
             for line in f:
                 line = line.strip()
                 if line and len(line) == 16:
-                    self.program.append(int(line, 2))
+                    program.append(int(line, 2))
+        self.program = program
         print(f"✓ Loaded {len(self.program)} instructions from {filename}")
     
     def load_as(self, filename):
@@ -88,8 +496,9 @@ class BatPU2:
             tmp_name = tmp.name
         
         try:
-            assemble(filename, tmp_name)
+            labels = assemble(filename, tmp_name)
             self.load_mc(tmp_name)
+            self.labels = labels
         finally:
             os.unlink(tmp_name)
     
@@ -130,189 +539,323 @@ class BatPU2:
             self.halted = True
             return False
         
-        instruction = self.program[self.pc]
-        d = self.decode(instruction)
-        opcode = d['opcode']
-        
-        # r0 is always 0
-        self.registers[0] = 0
-        
-        next_pc = self.pc + 1
-        
-        if opcode == 0:  # NOP
-            pass
-        
-        elif opcode == 1:  # HLT
-            self.halted = True
+        opcode, reg_a, reg_b, reg_c, imm = self._decoded[self.pc]
+        next_pc = self._dispatch[opcode](reg_a, reg_b, reg_c, imm)
+        if next_pc is None:
             return False
         
-        elif opcode == 2:  # ADD
-            result = self.registers[d['reg_a']] + self.registers[d['reg_b']]
-            self.carry_flag = result > 255
-            result &= 0xFF
-            self.zero_flag = result == 0
-            if d['reg_c'] != 0:
-                self.registers[d['reg_c']] = result
-        
-        elif opcode == 3:  # SUB
-            result = self.registers[d['reg_a']] - self.registers[d['reg_b']]
-            self.carry_flag = result >= 0  # No borrow = carry
-            result &= 0xFF
-            self.zero_flag = result == 0
-            if d['reg_c'] != 0:
-                self.registers[d['reg_c']] = result
-        
-        elif opcode == 4:  # NOR
-            result = ~(self.registers[d['reg_a']] | self.registers[d['reg_b']]) & 0xFF
-            self.zero_flag = result == 0
-            if d['reg_c'] != 0:
-                self.registers[d['reg_c']] = result
-        
-        elif opcode == 5:  # AND
-            result = self.registers[d['reg_a']] & self.registers[d['reg_b']]
-            self.zero_flag = result == 0
-            if d['reg_c'] != 0:
-                self.registers[d['reg_c']] = result
-        
-        elif opcode == 6:  # XOR
-            result = self.registers[d['reg_a']] ^ self.registers[d['reg_b']]
-            self.zero_flag = result == 0
-            if d['reg_c'] != 0:
-                self.registers[d['reg_c']] = result
-        
-        elif opcode == 7:  # RSH
-            result = self.registers[d['reg_a']] >> 1
-            self.carry_flag = self.registers[d['reg_a']] & 1
-            self.zero_flag = result == 0
-            if d['reg_c'] != 0:
-                self.registers[d['reg_c']] = result
-        
-        elif opcode == 8:  # LDI
-            if d['reg_a'] != 0:
-                self.registers[d['reg_a']] = d['imm8']
-        
-        elif opcode == 9:  # ADI
-            result = self.registers[d['reg_a']] + d['imm8_signed']
-            self.carry_flag = result > 255 or result < 0
-            result &= 0xFF
-            self.zero_flag = result == 0
-            if d['reg_a'] != 0:
-                self.registers[d['reg_a']] = result
-        
-        elif opcode == 10:  # JMP
-            next_pc = d['imm10']
-        
-        elif opcode == 11:  # BRH
-            condition = d['condition']
-            should_branch = False
-            if condition == 0:  # EQ/Z
-                should_branch = self.zero_flag
-            elif condition == 1:  # NE/NZ
-                should_branch = not self.zero_flag
-            elif condition == 2:  # GE/C
-                should_branch = self.carry_flag
-            elif condition == 3:  # LT/NC
-                should_branch = not self.carry_flag
-            
-            if should_branch:
-                next_pc = d['imm10']
-        
-        elif opcode == 12:  # CAL
-            if len(self.call_stack) < 16:
-                self.call_stack.append(self.pc + 1)
-                next_pc = d['imm10']
-            else:
-                print("⚠ Call stack overflow!")
-        
-        elif opcode == 13:  # RET
-            if self.call_stack:
-                next_pc = self.call_stack.pop()
-            else:
-                print("⚠ Call stack underflow!")
-        
-        elif opcode == 14:  # LOD regA regB offset → regA = memory[regB + offset]
-            addr = (self.registers[d['reg_b']] + d['offset']) & 0xFF
-            # Handle ports (240-255)
-            if addr >= 240:
-                value = self._read_port(addr)
-            else:
-                value = self.memory[addr]
-            if d['reg_a'] != 0:
-                self.registers[d['reg_a']] = value
-        
-        elif opcode == 15:  # STR regA regB offset → memory[regA + offset] = regB
-            addr = (self.registers[d['reg_a']] + d['offset']) & 0xFF
-            value = self.registers[d['reg_b']]
-            # Handle ports (240-255)
-            if addr >= 240:
-                self._write_port(addr, value)
-            else:
-                self.memory[addr] = value
-        
         self.pc = next_pc
         self.instruction_count += 1
-        self.registers[0] = 0  # Ensure r0 stays 0
-        
         return True
     
+    # Opcode handlers, indexed by opcode through self._dispatch.
+    # Each one takes the predecoded operands and returns the next PC, or None
+    # to stop. r0 stays 0 because no handler ever writes register 0.
+    
+    def _op_nop(self, reg_a, reg_b, reg_c, imm):
+        return self.pc + 1
+    
+    def _op_hlt(self, reg_a, reg_b, reg_c, imm):
+        self.halted = True
+        return None
+    
+    def _op_add(self, reg_a, reg_b, reg_c, imm):
+        result = self.registers[reg_a] + self.registers[reg_b]
+        self.carry_flag = result > 255
+        result &= 0xFF
+        self.zero_flag = result == 0
+        if reg_c != 0:
+            self.registers[reg_c] = result
+        return self.pc + 1
+    
+    def _op_sub(self, reg_a, reg_b, reg_c, imm):
+        result = self.registers[reg_a] - self.registers[reg_b]
+        self.carry_flag = result >= 0  # No borrow = carry
+        result &= 0xFF
+        self.zero_flag = result == 0
+        if reg_c != 0:
+            self.registers[reg_c] = result
+        return self.pc + 1
+    
+    def _op_nor(self, reg_a, reg_b, reg_c, imm):
+        result = ~(self.registers[reg_a] | self.registers[reg_b]) & 0xFF
+        self.zero_flag = result == 0
+        if reg_c != 0:
+            self.registers[reg_c] = result
+        return self.pc + 1
+    
+    def _op_and(self, reg_a, reg_b, reg_c, imm):
+        result = self.registers[reg_a] & self.registers[reg_b]
+        self.zero_flag = result == 0
+        if reg_c != 0:
+            self.registers[reg_c] = result
+        return self.pc + 1
+    
+    def _op_xor(self, reg_a, reg_b, reg_c, imm):
+        result = self.registers[reg_a] ^ self.registers[reg_b]
+        self.zero_flag = result == 0
+        if reg_c != 0:
+            self.registers[reg_c] = result
+        return self.pc + 1
+    
+    def _op_rsh(self, reg_a, reg_b, reg_c, imm):
+        result = self.registers[reg_a] >> 1
+        self.carry_flag = self.registers[reg_a] & 1
+        self.zero_flag = result == 0
+        if reg_c != 0:
+            self.registers[reg_c] = result
+        return self.pc + 1
+    
+    def _op_ldi(self, reg_a, reg_b, reg_c, imm):
+        if reg_a != 0:
+            self.registers[reg_a] = imm
+        return self.pc + 1
+    
+    def _op_adi(self, reg_a, reg_b, reg_c, imm):
+        result = self.registers[reg_a] + imm
+        self.carry_flag = result > 255 or result < 0
+        result &= 0xFF
+        self.zero_flag = result == 0
+        if reg_a != 0:
+            self.registers[reg_a] = result
+        return self.pc + 1
+    
+    def _op_jmp(self, reg_a, reg_b, reg_c, imm):
+        return imm
+    
+    def _op_brh(self, reg_a, reg_b, reg_c, imm):
+        # reg_a holds the condition for BRH
+        if BRANCH_CONDITIONS[reg_a](self):
+            return imm
+        return self.pc + 1
+    
+    def _op_cal(self, reg_a, reg_b, reg_c, imm):
+        depth = self.stack_depth
+        if depth < STACK_SIZE:
+            self.stack[depth] = self.pc + 1
+            self.stack_depth = depth + 1
+            return imm
+        print("⚠ Call stack overflow!")
+        return self.pc + 1
+    
+    def _op_ret(self, reg_a, reg_b, reg_c, imm):
+        depth = self.stack_depth
+        if depth:
+            self.stack_depth = depth - 1
+            return self.stack[depth - 1]
+        print("⚠ Call stack underflow!")
+        return self.pc + 1
+    
+    def _op_lod(self, reg_a, reg_b, reg_c, imm):
+        # LOD regA regB offset → regB = memory[regA + offset]
+        addr = (self.registers[reg_a] + imm) & 0xFF
+        # Handle ports (240-255)
+        if addr >= 240:
+            value = self._port_readers[addr - 240](self)
+        else:
+            value = self.memory[addr]
+        if reg_b != 0:
+            self.registers[reg_b] = value
+        return self.pc + 1
+    
+    def _op_str(self, reg_a, reg_b, reg_c, imm):
+        # STR regA regB offset → memory[regA + offset] = regB
+        addr = (self.registers[reg_a] + imm) & 0xFF
+        value = self.registers[reg_b]
+        # Handle ports (240-255)
+        if addr >= 240:
+            self._port_writers[addr - 240](self, value)
+        else:
+            self.memory[addr] = value
+        return self.pc + 1
+    
     def _read_port(self, port):
         """Read from I/O port"""
-        port_name = port - 240
-        if port_name == 4:  # load_pixel
-            x = self.pixel_x % 32
-            y = self.pixel_y % 32
-            return self.screen[y][x]
-        elif port_name == 14:  # rng
-            import random
-            return random.randint(0, 255)
-        elif port_name == 15:  # controller_input
-            return 0  # No input
-        return 0
+        return self._port_readers[port - 240](self)
     
     def _write_port(self, port, value):
         """Write to I/O port"""
-        port_name = port - 240
-        if port_name == 0:  # pixel_x
-            self.pixel_x = value
-        elif port_name == 1:  # pixel_y
-            self.pixel_y = value
-        elif port_name == 2:  # draw_pixel
-            x = self.pixel_x % 32
-            y = self.pixel_y % 32
-            self.screen[y][x] = 1
-        elif port_name == 3:  # clear_pixel
-            x = self.pixel_x % 32
-            y = self.pixel_y % 32
-            self.screen[y][x] = 0
-        elif port_name == 7:  # write_char
-            chars = [' ', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z', '.', '!', '?']
-            if 0 <= value < len(chars):
-                self.char_buffer.append(chars[value])
-            elif 32 <= value <= 126: # ASCII text fallback
-                self.char_buffer.append(chr(value))
-            else:
-                self.char_buffer.append('?')
-        elif port_name == 10:  # show_number
-            if self.signed_mode and value >= 128:
-                self.number_display = value - 256
-            else:
-                self.number_display = value
-        elif port_name == 11:  # clear_number
-            self.number_display = None
-        elif port_name == 12:  # signed_mode
-            self.signed_mode = True
-        elif port_name == 13:  # unsigned_mode
-            self.signed_mode = False
-    
-    def run(self, max_instructions=10000):
-        """Run until halted or max instructions reached"""
-        while self.instruction_count < max_instructions:
-            if not self.execute_one():
-                break
+        self._port_writers[port - 240](self, value)
+    
+    def attach_device(self, port, read=None, write=None):
+        """Install a device on an I/O port (240-255 or a name from PORTS)
         
-        if self.instruction_count >= max_instructions:
+        read(cpu) returns the byte LOD sees, write(cpu, value) receives the
+        byte STR stores. Leaving one as None keeps the current handler.
+        """
+        index = port_index(port)
+        if read is not None:
+            if self._port_readers is DEFAULT_PORT_READERS:
+                self._port_readers = list(DEFAULT_PORT_READERS)
+            self._port_readers[index] = read
+        if write is not None:
+            if self._port_writers is DEFAULT_PORT_WRITERS:
+                self._port_writers = list(DEFAULT_PORT_WRITERS)
+            self._port_writers[index] = write
+    
+    def detach_device(self, port):
+        """Put the built-in handlers back on an I/O port"""
+        index = port_index(port)
+        if self._port_readers is not DEFAULT_PORT_READERS:
+            self._port_readers[index] = DEFAULT_PORT_READERS[index]
+        if self._port_writers is not DEFAULT_PORT_WRITERS:
+            self._port_writers[index] = DEFAULT_PORT_WRITERS[index]
+    
+    # Built-in I/O devices, see DEFAULT_PORT_READERS / DEFAULT_PORT_WRITERS
+    
+    def _io_read_none(self):
+        return 0
+    
+    def _io_write_none(self, value):
+        pass
+    
+    def _io_pixel_x(self, value):
+        self.pixel_x = value
+    
+    def _io_pixel_y(self, value):
+        self.pixel_y = value
+    
+    def _io_draw_pixel(self, value):
+        self.set_pixel(self.pixel_x % 32, self.pixel_y % 32, 1)
+    
+    def _io_clear_pixel(self, value):
+        self.set_pixel(self.pixel_x % 32, self.pixel_y % 32, 0)
+    
+    def _io_load_pixel(self):
+        return self.get_pixel(self.pixel_x % 32, self.pixel_y % 32)
+    
+    def _io_buffer_screen(self, value):
+        self.buffer_screen()
+    
+    def _io_clear_screen_buffer(self, value):
+        self.clear_screen_buffer()
+    
+    def _io_write_char(self, value):
+        if self.char_count < CHAR_DISPLAY_SIZE:
+            self.char_buffer[self.char_count] = CHAR_CODES[value]
+            self.char_count += 1
+    
+    def _io_buffer_chars(self, value):
+        self.char_display = self.pending_chars
+    
+    def _io_clear_chars_buffer(self, value):
+        self.char_count = 0
+    
+    def _io_show_number(self, value):
+        if self.signed_mode and value >= 128:
+            self.number_display = value - 256
+        else:
+            self.number_display = value
+    
+    def _io_clear_number(self, value):
+        self.number_display = None
+    
+    def _io_signed_mode(self, value):
+        self.signed_mode = True
+    
+    def _io_unsigned_mode(self, value):
+        self.signed_mode = False
+    
+    def _io_rng(self):
+        if self.rng_pos < len(self.rng_stream):
+            self.rng_pos += 1
+            return self.rng_stream[self.rng_pos - 1]
+        x = self.rng_state
+        x ^= (x << 13) & 0xFFFFFFFF
+        x ^= x >> 17
+        x ^= (x << 5) & 0xFFFFFFFF
+        self.rng_state = x
+        return x >> 24
+    
+    def _io_controller_input(self):
+        return 0  # No input
+    
+    def run(self, max_instructions=10000, engine=None, profile=None):
+        """Run until halted or max instructions reached, or a breakpoint stops it
+        
+        Passing a profiler.Profile (or CallGraphProfile, AccessProfile) runs
+        its profiling interpreter loop instead of the engine, breakpoints are
+        not checked then.
+        """
+        skipped = self.idle_skipped
+        hit = self.advance(max_instructions, engine, profile)
+        
+        if self.idle_skipped > skipped:
+            print(f"⏩ Fast-forwarded {self.idle_skipped - skipped} idle instructions")
+        if isinstance(hit, Cycle):
+            print(f"⟳ Stopped in an {hit.describe()}")
+        elif hit is not None:
+            print(f"● Stopped at {hit.describe()}")
+        elif self.instruction_count >= max_instructions:
             print(f"⚠ Stopped after {max_instructions} instructions (possible infinite loop)")
     
+    def advance(self, max_instructions, engine=None, profile=None, debug=True, resume=True, idle_limit=None,
+                cycles=None):
+        """Run until halted or instruction_count reaches max_instructions, quietly
+        
+        Returns the breakpoint or watchpoint that stopped the run, the
+        idle.Cycle with cycle_check (cycles: an idle.CycleTable carried over from
+        the call this one continues), or None. With breakpoints set the run
+        goes through breakpoints.run_debug(), resume skips a breakpoint on
+        the starting PC. Replays pass debug=False to run through both.
+        With fast_forward, idle controller polling loops are skipped, as far
+        as idle_limit when given (the run then ends past max_instructions). With
+        hle, accelerate_loops or memoize, run_accelerated() replaces the engine.
+        """
+        if profile is not None:
+            profile.run(self, max_instructions)
+            return None
+        if debug and self.breakpoints:
+            return run_debug(self, max_instructions, resume)
+        engine = engine or self.engine
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine} (choose from {', '.join(ENGINES)})")
+        next_change = self._input_next_change() if self.fast_forward or self.cycle_check else None
+        if next_change is not None and debug and self.cycle_check:
+            return find_cycle(self, max_instructions, next_change, cycles)
+        run = (run_accelerated if self.hle or self.hle_verify or self.accelerate_loops or self.memoize
+               else ENGINES[engine])
+        if next_change is not None and self.fast_forward:
+            self.idle_skipped += run_idle(self, max_instructions, run, next_change, idle_limit)
+        else:
+            run(self, max_instructions)
+        return None
+    
+    def _input_next_change(self):
+        # When controller input can next change, for run_idle(): never with
+        # no controller, next_change() for devices providing it (InputTimeline).
+        # None if idle loops can't be skipped, other devices could notice.
+        if (self._port_writers is not DEFAULT_PORT_WRITERS
+                or tuple(self._port_readers[:15]) != DEFAULT_PORT_READERS[:15]):
+            return None
+        read = self._port_readers[15]
+        if read is DEFAULT_PORT_READERS[15]:
+            return never
+        return getattr(getattr(read, '__self__', None), 'next_change', None)
+    
+    def watch(self, address, read=False, write=True, condition=None, ignore=0):
+        """Set a watchpoint on a RAM address or an I/O port (240-255 or a name from PORTS)"""
+        if isinstance(address, str) or address >= 240:
+            address = 240 + port_index(address)
+        return self.breakpoints.watch(address, read, write, condition, ignore)
+    
+    def _run_interpreter(self, max_instructions):
+        """Plain interpreter loop"""
+        # Same as calling execute_one() in a loop, with the lookups hoisted
+        decoded = self._decoded
+        dispatch = self._dispatch
+        program_length = len(decoded)
+        while self.instruction_count < max_instructions:
+            if self.halted or self.pc >= program_length:
+                self.halted = True
+                break
+            opcode, reg_a, reg_b, reg_c, imm = decoded[self.pc]
+            next_pc = dispatch[opcode](reg_a, reg_b, reg_c, imm)
+            if next_pc is None:
+                break
+            self.pc = next_pc
+            self.instruction_count += 1
+    
     def disassemble(self, instruction):
         """Disassemble an instruction to readable format"""
         d = self.decode(instruction)
@@ -349,6 +892,7 @@ class BatPU2:
         """Print current CPU state"""
         print("\n" + "="*60)
         print(f"  PC: {self.pc:4d}  |  Instructions: {self.instruction_count}  |  {'HALTED' if self.halted else 'RUNNING'}")
+        print(f"  RNG seed: {self.rng_seed}")
         print(f"  Flags: Z={int(self.zero_flag)} C={int(self.carry_flag)}")
         print("-"*60)
         print("  Registers:")
@@ -359,8 +903,8 @@ class BatPU2:
         if self.number_display is not None:
             print(f"\n  Number Display: {self.number_display}")
         
-        if self.char_buffer:
-            print(f"  Char Buffer: {''.join(self.char_buffer)}")
+        if self.chars:
+            print(f"  Char Display: {self.chars}")
         
         # Show next instruction
         if self.pc < len(self.program) and not self.halted:
@@ -370,7 +914,7 @@ class BatPU2:
     
     def print_screen(self):
         """Print the screen buffer"""
-        print("\n  Screen (32x32):")
+        print(f"\n  Screen (32x32), frame {self.frame_count}:")
         print("  +" + "-"*32 + "+")
         for row in self.screen:
             line = "".join("█" if p else " " for p in row)
@@ -385,6 +929,114 @@ class BatPU2:
             print(f"  {i:3d}: " + " ".join(values))
 
 
+# Built-in device handlers for ports 240-255
+DEFAULT_PORT_READERS = (
+    BatPU2._io_read_none, BatPU2._io_read_none, BatPU2._io_read_none, BatPU2._io_read_none,
+    BatPU2._io_load_pixel, BatPU2._io_read_none, BatPU2._io_read_none, BatPU2._io_read_none,
+    BatPU2._io_read_none, BatPU2._io_read_none, BatPU2._io_read_none, BatPU2._io_read_none,
+    BatPU2._io_read_none, BatPU2._io_read_none, BatPU2._io_rng, BatPU2._io_controller_input,
+)
+DEFAULT_PORT_WRITERS = (
+    BatPU2._io_pixel_x, BatPU2._io_pixel_y, BatPU2._io_draw_pixel, BatPU2._io_clear_pixel,
+    BatPU2._io_write_none, BatPU2._io_buffer_screen, BatPU2._io_clear_screen_buffer, BatPU2._io_write_char,
+    BatPU2._io_buffer_chars, BatPU2._io_clear_chars_buffer, BatPU2._io_show_number, BatPU2._io_clear_number,
+    BatPU2._io_signed_mode, BatPU2._io_unsigned_mode, BatPU2._io_write_none, BatPU2._io_write_none,
+)
+
+
+class _BootStop(Exception):
+    """Raised by the boot run's port handlers where the prologue ends"""
+
+
+def _stop_boot(cpu):
+    raise _BootStop
+
+
+def _boot_buffer_screen(cpu, value):
+    # Blank frames can't be seen, the prologue ends at the first visible one
+    if cpu.framebuffer != cpu.display:
+        raise _BootStop
+    cpu.buffer_screen()
+
+
+def boot_state(program_hash, program, cache_dir=DEFAULT_CACHE_DIR):
+    """Snapshot of a program run from reset up to its first rng or controller_input read
+    
+    Everything before that read only depends on the program, so the state is
+    computed once and cached by program hash, in memory and on disk. The run
+    also stops before the first visible frame is published, so animations are
+    not skipped ahead, and after BOOT_LIMIT instructions or at HLT.
+    """
+    state = _boot_states.get(program_hash)
+    if state is not None:
+        return state
+    
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, f'{program_hash}.{SNAPSHOT_VERSION}.{BOOT_VERSION}.{BOOT_LIMIT}.boot')
+        try:
+            with open(path, 'rb') as f:
+                state = f.read()
+        except OSError:
+            pass
+    
+    if state is None or len(state) != SNAPSHOT_FORMAT.size:
+        cpu = BatPU2(0)
+        cpu.program = program
+        cpu.attach_device('rng', read=_stop_boot)
+        cpu.attach_device('controller_input', read=_stop_boot)
+        cpu.attach_device('buffer_screen', write=_boot_buffer_screen)
+        try:
+            run_threaded(cpu, BOOT_LIMIT)
+        except _BootStop:
+            pass  # The read has not been executed, pc still points at it
+        state = cpu.snapshot()
+        if path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(state)
+                os.replace(tmp_path, path)
+            except OSError:
+                pass  # The cache is only an optimisation
+    
+    if len(_boot_states) >= PROGRAM_IMAGE_CACHE_SIZE:
+        del _boot_states[next(iter(_boot_states))]
+    _boot_states[program_hash] = state
+    return state
+
+
+def run_accelerated(cpu, max_instructions):
+    """Threaded engine with native routines (hle.py), counted loop
+    acceleration (loops.py) and pure subroutine memoization (memo.py)
+    trapped in, as enabled on the CPU"""
+    if cpu.halted:
+        return
+    key = (cpu.hle or cpu.hle_verify, cpu.hle_verify, cpu.accelerate_loops, cpu.memoize, hle._version)
+    base = load_handlers(cpu)
+    cached = cpu._compiled.get('accelerated')
+    if cached is None or cached[0] != key or cached[1] is not base:
+        traps = {}
+        if cpu.accelerate_loops:
+            traps.update(loops.traps(cpu))
+        if cpu.memoize:
+            traps.update(memo.traps(cpu))
+        if cpu.hle or cpu.hle_verify:
+            traps.update(hle.traps(cpu))
+        cached = cpu._compiled['accelerated'] = (key, base, traps, patch_handlers(cpu, traps))
+    run_traps(cpu, max_instructions, cached[3], cached[2])
+
+
+# Execution engines selectable with BatPU2.run(engine=...) or --engine
+ENGINES = {
+    'interp': BatPU2._run_interpreter,  # Predecoded interpreter
+    'aot': run_aot,                     # Whole-program translation to Python (translator.py)
+    'tiered': run_tiered,               # Interpreter + hot block compilation (translator.py)
+    'threaded': run_threaded,           # Per-instruction closures (threaded.py)
+}
+
+
 def interactive_mode(cpu):
     """Interactive debugger mode"""
     print("\n" + "="*60)
@@ -392,21 +1044,37 @@ def interactive_mode(cpu):
     print("="*60)
     print("  Commands:")
     print("    s, step     - Execute one instruction")
-    print("    r, run      - Run until halt")
+    print("    r, run      - Run until halt (or a breakpoint)")
     print("    n, run N    - Run N instructions")
+    print("    b, back [N] - Step back N instructions (default 1)")
+    print("    rc          - Run backwards to the previous breakpoint")
+    print("    break ADDR [if COND]")
+    print("                - Set a (conditional) breakpoint, or remove it")
+    print("    watch ADDR|PORT [r|w|rw] [if COND]")
+    print("                - Stop when a LOD/STR touches an address or port")
+    print("    unwatch ADDR|PORT")
+    print("    info        - List breakpoints and watchpoints with hit counts")
+    print("                  COND is Python over r[n], mem[n], z, c, pc, count, value")
     print("    p, print    - Print CPU state")
     print("    m, mem      - Print memory")
     print("    scr, screen - Print screen buffer")
     print("    d, disasm   - Disassemble program")
     print("    reset       - Reset CPU")
+    print("    boot        - Skip to the program's first rng/controller read (cached)")
+    print("    save FILE   - Save the machine state to FILE")
+    print("    load FILE   - Restore the machine state from FILE")
     print("    q, quit     - Quit")
     print("="*60)
     
     cpu.print_state()
     
+    # Checkpointed execution, for stepping back
+    history = History(cpu)
+    
     while True:
         try:
-            cmd = input("\n> ").strip().lower().split()
+            line = input("\n> ").strip()
+            cmd = line.lower().split()
             if not cmd:
                 continue
             
@@ -414,25 +1082,62 @@ def interactive_mode(cpu):
                 break
             
             elif cmd[0] in ['s', 'step']:
-                if cpu.execute_one():
+                if history.step():
                     cpu.print_state()
                 else:
                     print("  Program halted.")
                     cpu.print_state()
             
             elif cmd[0] in ['r', 'run']:
-                if len(cmd) > 1:
-                    try:
-                        n = int(cmd[1])
-                        for _ in range(n):
-                            if not cpu.execute_one():
-                                break
-                    except ValueError:
-                        cpu.run()
+                try:
+                    hit = history.run(cpu.instruction_count + int(cmd[1]))
+                except (IndexError, ValueError):
+                    hit = history.run(10000)
+                    if hit is None and cpu.instruction_count >= 10000:
+                        print("⚠ Stopped after 10000 instructions (possible infinite loop)")
+                if hit is not None:
+                    print(f"● Stopped at {hit.describe()}")
+                cpu.print_state()
+            
+            elif cmd[0] in ['b', 'back']:
+                if history.reverse_step(int(cmd[1]) if len(cmd) > 1 else 1):
+                    cpu.print_state()
                 else:
-                    cpu.run()
+                    print(f"  Already at the oldest checkpoint (instruction {history.start}).")
+            
+            elif cmd[0] == 'rc':
+                if not history.reverse_continue():
+                    print(f"  No earlier breakpoint, back at instruction {history.start}.")
                 cpu.print_state()
             
+            elif cmd[0] == 'break' and len(cmd) > 1:
+                addr = int(cmd[1])
+                condition = line.lower().split(' if ', 1)[1] if ' if ' in line.lower() else None
+                if addr in cpu.breakpoints and condition is None:
+                    cpu.breakpoints.remove(addr)
+                    print(f"  Breakpoint removed at {addr}.")
+                else:
+                    print(f"  Set {cpu.breakpoints.add(addr, condition).describe()}.")
+            
+            elif cmd[0] == 'watch' and len(cmd) > 1:
+                address = int(cmd[1]) if cmd[1].isdigit() else cmd[1]
+                access = cmd[2] if len(cmd) > 2 and cmd[2] in ('r', 'w', 'rw') else 'w'
+                condition = line.lower().split(' if ', 1)[1] if ' if ' in line.lower() else None
+                point = cpu.watch(address, read='r' in access, write='w' in access, condition=condition)
+                print(f"  Set {point.describe()}.")
+            
+            elif cmd[0] == 'unwatch' and len(cmd) > 1:
+                address = int(cmd[1]) if cmd[1].isdigit() else 240 + port_index(cmd[1])
+                cpu.breakpoints.unwatch(address)
+                print(f"  Watchpoint removed on {address}.")
+            
+            elif cmd[0] == 'info':
+                points = list(cpu.breakpoints.points.values()) + list(cpu.breakpoints.watches.values())
+                for point in points:
+                    print(f"  {point.describe()}: {point.hits} hits")
+                if not points:
+                    print("  No breakpoints or watchpoints.")
+            
             elif cmd[0] in ['p', 'print', 'state']:
                 cpu.print_state()
             
@@ -454,9 +1159,34 @@ def interactive_mode(cpu):
             
             elif cmd[0] == 'reset':
                 cpu.reset()
+                history.clear()
                 print("  CPU reset.")
                 cpu.print_state()
             
+            elif cmd[0] == 'boot':
+                cpu.reset()
+                if cpu.boot():
+                    print(f"  Skipped {cpu.instruction_count} prologue instructions.")
+                else:
+                    print("  Nothing to skip.")
+                history.clear()
+                cpu.print_state()
+            
+            elif cmd[0] == 'save' and len(cmd) > 1:
+                # File names keep their case
+                filename = line.split(None, 1)[1]
+                with open(filename, 'wb') as f:
+                    f.write(cpu.snapshot())
+                print(f"  State saved to {filename}.")
+            
+            elif cmd[0] == 'load' and len(cmd) > 1:
+                filename = line.split(None, 1)[1]
+                with open(filename, 'rb') as f:
+                    cpu.restore(f.read())
+                history.clear()
+                print(f"  State restored from {filename}.")
+                cpu.print_state()
+            
             else:
                 print(f"  Unknown command: {cmd[0]}")
         
@@ -468,20 +1198,76 @@ def interactive_mode(cpu):
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python simulator.py <program.as|program.mc> [--run]")
+        print("Usage: python simulator.py <program.as|program.mc> [--run] [--engine NAME] [--seed N]")
+        print("                             [--input FILE] [--max N] [--profile FILE]")
         print("")
         print("Options:")
-        print("  --run    Run program directly instead of interactive mode")
+        print("  --run          Run program directly instead of interactive mode")
+        print(f"  --engine NAME  Execution engine: {', '.join(ENGINES)} (default: interp)")
+        print("  --seed N       Seed for the rng port (default: random)")
+        print("  --input FILE   Drive controller_input from an input script (see controller.py)")
+        print("  --max N        Instruction limit for --run (default: 10000)")
+        print("  --cold-boot    Run the program prologue instead of using the boot cache")
+        print("  --fast-forward Skip idle controller polling loops (exact, just faster)")
+        print("  --detect-loops Stop as soon as the program provably loops forever")
+        print("  --hle          Run native versions of known subroutines (see hle.py)")
+        print("  --hle-verify   Check every native call against the interpreter")
+        print("  --fast-loops   Run counted loops in closed form (see loops.py)")
+        print("  --memoize      Skip repeat calls of pure subroutines (see memo.py)")
+        print("  --profile FILE Profile the run, print hot spots and save them (.json or callgrind)")
+        print("  --call-graph   Profile subroutines too, --profile FILE.folded saves flame graph stacks")
+        print("  --memory       Profile RAM and I/O port accesses instead (saved as JSON)")
         print("")
         print("Examples:")
         print("  python simulator.py programs/helloworld.as")
         print("  python simulator.py programs/helloworld.mc --run")
+        print("  python simulator.py programs/tetris.mc --run --input session.txt --max 5000000")
         sys.exit(1)
     
     filename = sys.argv[1]
     run_mode = '--run' in sys.argv
     
-    cpu = BatPU2()
+    seed = None
+    if '--seed' in sys.argv:
+        index = sys.argv.index('--seed')
+        try:
+            seed = int(sys.argv[index + 1], 0)
+        except (IndexError, ValueError):
+            print("--seed needs an integer")
+            sys.exit(1)
+    
+    max_instructions = 10000
+    if '--max' in sys.argv:
+        index = sys.argv.index('--max')
+        try:
+            max_instructions = int(sys.argv[index + 1])
+        except (IndexError, ValueError):
+            print("--max needs an integer")
+            sys.exit(1)
+    
+    cpu = BatPU2(seed)
+    cpu.fast_forward = '--fast-forward' in sys.argv
+    cpu.cycle_check = '--detect-loops' in sys.argv
+    cpu.hle = '--hle' in sys.argv
+    cpu.hle_verify = '--hle-verify' in sys.argv
+    cpu.accelerate_loops = '--fast-loops' in sys.argv
+    cpu.memoize = '--memoize' in sys.argv
+    
+    if '--input' in sys.argv:
+        index = sys.argv.index('--input')
+        try:
+            InputTimeline.load(sys.argv[index + 1]).attach(cpu)
+        except (IndexError, OSError, ValueError) as e:
+            print(f"Cannot load input script: {e}")
+            sys.exit(1)
+    
+    if '--engine' in sys.argv:
+        index = sys.argv.index('--engine')
+        cpu.engine = sys.argv[index + 1] if index + 1 < len(sys.argv) else ''
+        if cpu.engine not in ENGINES:
+            print(f"Unknown engine: {cpu.engine}")
+            print(f"Supported: {', '.join(ENGINES)}")
+            sys.exit(1)
     
     if filename.endswith('.as'):
         cpu.load_as(filename)
@@ -493,10 +1279,34 @@ def main():
         sys.exit(1)
     
     if run_mode:
-        cpu.run()
+        profile = None
+        if '--profile' in sys.argv:
+            index = sys.argv.index('--profile')
+            if index + 1 >= len(sys.argv):
+                print("--profile needs a file name")
+                sys.exit(1)
+            if '--memory' in sys.argv:
+                profile = AccessProfile()
+            elif '--call-graph' in sys.argv:
+                profile = CallGraphProfile()
+            else:
+                profile = Profile()
+        elif '--memory' in sys.argv or '--call-graph' in sys.argv:
+            print("--memory and --call-graph need --profile FILE")
+            sys.exit(1)
+        # A profile covers the whole run, prologue included
+        if '--cold-boot' not in sys.argv and profile is None:
+            cpu.boot(max_instructions)
+        cpu.run(max_instructions, profile=profile)
         cpu.print_state()
-        if any(any(row) for row in cpu.screen):
+        if any(cpu.screen_view()):
             cpu.print_screen()
+        if cpu.memoize:
+            print(memo.table(cpu).report())
+        if profile is not None:
+            print(profile.report(cpu))
+            profile.save(sys.argv[index + 1], cpu)
+            print(f"✓ Profile saved to {sys.argv[index + 1]}")
     else:
         interactive_mode(cpu)
 
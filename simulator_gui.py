@@ -5,6 +5,7 @@ Drag & drop interface for assembly files
 """
 
 from http.server import HTTPServer, SimpleHTTPRequestHandler
+import base64
 import json
 import os
 import sys
@@ -15,8 +16,23 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from assembler import assemble
 from simulator import BatPU2
+from history import History
+from profiler import AccessProfile
 
 cpu = BatPU2()
+cpu.engine = 'threaded'
+# Skip input polling loops while nobody presses anything, the result is exact
+cpu.fast_forward = True
+# Checkpointed execution behind step/run, for reverse-step and reverse-continue
+history = History(cpu)
+
+def boot(cpu, max_instructions):
+    # A run from instruction 0 starts past the program's deterministic
+    # prologue, unless the user has breakpoints to stop in it or the heatmap
+    # should count its accesses. History keeps its checkpoint at 0, so
+    # reverse-step replays the prologue.
+    if not cpu.breakpoints and history.profile is None:
+        cpu.boot(max_instructions)
 
 class SimulatorHandler(SimpleHTTPRequestHandler):
     
@@ -41,6 +57,8 @@ class SimulatorHandler(SimpleHTTPRequestHandler):
             self.get_state()
         elif self.path == '/api/disasm':
             self.get_disasm()
+        elif self.path == '/api/snapshot':
+            self.get_snapshot()
         elif self.path == '/favicon.ico':
             self.send_response(204)
             self.end_headers()
@@ -61,6 +79,16 @@ class SimulatorHandler(SimpleHTTPRequestHandler):
             self.reset()
         elif self.path == '/api/breakpoint':
             self.toggle_breakpoint(body)
+        elif self.path == '/api/restore':
+            self.restore(body)
+        elif self.path == '/api/reverse-step':
+            self.reverse_step(body)
+        elif self.path == '/api/reverse-continue':
+            self.reverse_continue()
+        elif self.path == '/api/heatmap':
+            self.set_heatmap(body)
+        elif self.path == '/api/watchpoint':
+            self.set_watchpoint(body)
         else:
             self.send_error(404)
     
@@ -82,28 +110,38 @@ class SimulatorHandler(SimpleHTTPRequestHandler):
         
         self.send_json({
             'pc': cpu.pc,
-            'registers': cpu.registers,
+            'registers': list(cpu.registers),
             'flags': {'zero': cpu.zero_flag, 'carry': cpu.carry_flag},
             'halted': cpu.halted,
             'instructions': cpu.instruction_count,
-            'memory': cpu.memory[:128],
+            'idleSkipped': cpu.idle_skipped,
+            'memory': list(cpu.memory[:128]),
             'programLength': len(cpu.program),
             'numberDisplay': cpu.number_display,
-            'charBuffer': ''.join(cpu.char_buffer),
+            'charBuffer': cpu.chars,
             'screen': cpu.screen,
+            'frameHash': f'{cpu.screen_hash:016x}',
+            'frameCount': cpu.frame_count,
             'outputs': outputs,
             'lastInstruction': cpu.disassemble(cpu.program[max(0, cpu.pc-1)]) if cpu.program and cpu.pc > 0 else None,
             # New fields for enhanced UI
-            'callStack': cpu.call_stack.copy(),
+            'callStack': cpu.call_stack,
             'pixelX': cpu.pixel_x,
             'pixelY': cpu.pixel_y,
             'signedMode': cpu.signed_mode,
-            'breakpoints': list(getattr(cpu, 'breakpoints', set()))
+            'rngSeed': cpu.rng_seed,
+            'breakpoints': list(cpu.breakpoints),
+            'breakpointInfo': [point.to_dict() for point in cpu.breakpoints.points.values()],
+            'watchpoints': [point.to_dict() for point in cpu.breakpoints.watches.values()],
+            'stoppedAt': cpu.breakpoints.hit.describe() if cpu.breakpoints.hit else None,
+            'historyStart': history.start,
+            # LOD/STR counts per address while the heatmap is on
+            'heatmap': {'reads': history.profile.reads, 'writes': history.profile.writes} if history.profile else None
         })
     
     def get_disasm(self):
         global cpu
-        breakpoints = getattr(cpu, 'breakpoints', set())
+        breakpoints = cpu.breakpoints
         lines = []
         for i, instr in enumerate(cpu.program[:200]):
             lines.append({
@@ -129,9 +167,13 @@ class SimulatorHandler(SimpleHTTPRequestHandler):
                 mc_file = f.name
             
             try:
-                assemble(as_file, mc_file)
+                labels = assemble(as_file, mc_file)
+                # A new random seed per load, unless one is given to replay a run
+                cpu.seed_rng(data.get('seed'))
                 cpu.reset()
                 cpu.load_mc(mc_file)
+                cpu.labels = labels
+                history.clear()
                 self.send_json({'success': True, 'message': f'✓ {len(cpu.program)} instructions'})
             except SystemExit as e:
                 self.send_json({'success': False, 'message': str(e)})
@@ -144,7 +186,7 @@ class SimulatorHandler(SimpleHTTPRequestHandler):
     def step(self):
         global cpu
         if not cpu.halted and cpu.pc < len(cpu.program):
-            cpu.execute_one()
+            history.step()
         self.get_state()
     
     def run_program(self, body):
@@ -152,16 +194,10 @@ class SimulatorHandler(SimpleHTTPRequestHandler):
         try:
             data = json.loads(body) if body else {}
             max_instr = data.get('max', 100000)
-            breakpoints = getattr(cpu, 'breakpoints', set())
-            
-            count = 0
-            while count < max_instr and not cpu.halted and cpu.pc < len(cpu.program):
-                cpu.execute_one()
-                count += 1
-                # Stop at breakpoint (but not on first instruction if we're already there)
-                if count > 0 and cpu.pc in breakpoints:
-                    break
-            
+            # Stops at breakpoints (but not on the first instruction if we're already there)
+            target = cpu.instruction_count + max_instr
+            boot(cpu, target)
+            history.run(target)
             self.get_state()
         except Exception as e:
             self.send_json({'error': str(e)})
@@ -171,15 +207,14 @@ class SimulatorHandler(SimpleHTTPRequestHandler):
         try:
             data = json.loads(body)
             addr = data.get('addr', 0)
+            condition = data.get('condition') or None
             
-            if not hasattr(cpu, 'breakpoints'):
-                cpu.breakpoints = set()
-            
-            if addr in cpu.breakpoints:
+            # Toggles, unless a condition or ignore count is given to set
+            if addr in cpu.breakpoints and condition is None and 'ignore' not in data:
                 cpu.breakpoints.remove(addr)
                 action = 'removed'
             else:
-                cpu.breakpoints.add(addr)
+                cpu.breakpoints.add(addr, condition, data.get('ignore', 0))
                 action = 'added'
             
             self.send_json({'success': True, 'action': action, 'addr': addr, 'breakpoints': list(cpu.breakpoints)})
@@ -188,11 +223,65 @@ class SimulatorHandler(SimpleHTTPRequestHandler):
     
     def reset(self):
         global cpu
-        program = cpu.program.copy()
         cpu.reset()
-        cpu.program = program
+        history.clear()
         self.get_state()
     
+    def reverse_step(self, body):
+        global cpu
+        try:
+            data = json.loads(body) if body else {}
+            history.reverse_step(data.get('count', 1))
+            self.get_state()
+        except Exception as e:
+            self.send_json({'error': str(e)})
+    
+    def reverse_continue(self):
+        global cpu
+        history.reverse_continue()
+        self.get_state()
+    
+    def set_watchpoint(self, body):
+        global cpu
+        try:
+            data = json.loads(body)
+            address = data.get('address', 0)
+            if data.get('remove'):
+                if not isinstance(address, int):
+                    address = 240 + cpu.ports.index(address)
+                cpu.breakpoints.unwatch(address)
+            else:
+                access = data.get('access', 'w')
+                cpu.watch(address, read='r' in access, write='w' in access,
+                          condition=data.get('condition') or None, ignore=data.get('ignore', 0))
+            self.get_state()
+        except Exception as e:
+            self.send_json({'success': False, 'message': str(e)})
+    
+    def set_heatmap(self, body):
+        global cpu
+        try:
+            data = json.loads(body) if body else {}
+            # Instrumented runs use the interpreter, so only count while asked to
+            history.profile = AccessProfile() if data.get('enabled') else None
+            self.get_state()
+        except Exception as e:
+            self.send_json({'error': str(e)})
+    
+    def get_snapshot(self):
+        global cpu
+        self.send_json({'snapshot': base64.b64encode(cpu.snapshot()).decode('ascii')})
+    
+    def restore(self, body):
+        global cpu
+        try:
+            data = json.loads(body)
+            cpu.restore(base64.b64decode(data.get('snapshot', '')))
+            history.clear()
+            self.get_state()
+        except Exception as e:
+            self.send_json({'success': False, 'message': str(e)})
+    
     def serve_file(self, filename, content_type):
         try:
             web_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web')
@@ -0,0 +1,248 @@
+"""
+BatPU-2 Threaded-Code Engine
+Converts each program word into a closure with its operands baked in, so the
+run loop is just `pc = handlers[pc]()`.
+
+Handlers return the next PC. They return None when the instruction needs the
+full machine state (HLT, I/O port accesses, falling off the end of the
+program), and the run loop hands that single instruction to the interpreter.
+"""
+
+
+def _slow_path():
+    return None
+
+
+def make_handler(cpu, pc, opcode, reg_a, reg_b, reg_c, imm):
+    """Build the closure executing one predecoded instruction at pc"""
+    registers = cpu.registers
+    memory = cpu.memory
+    next_pc = pc + 1
+
+    if opcode == 0:  # NOP
+        def handler():
+            return next_pc
+
+    elif opcode == 1:  # HLT
+        handler = _slow_path
+
+    elif opcode == 2:  # ADD
+        def handler():
+            result = registers[reg_a] + registers[reg_b]
+            cpu.carry_flag = result > 255
+            result &= 0xFF
+            cpu.zero_flag = result == 0
+            if reg_c:
+                registers[reg_c] = result
+            return next_pc
+
+    elif opcode == 3:  # SUB
+        def handler():
+            result = registers[reg_a] - registers[reg_b]
+            cpu.carry_flag = result >= 0  # No borrow = carry
+            result &= 0xFF
+            cpu.zero_flag = result == 0
+            if reg_c:
+                registers[reg_c] = result
+            return next_pc
+
+    elif opcode == 4:  # NOR
+        def handler():
+            result = ~(registers[reg_a] | registers[reg_b]) & 0xFF
+            cpu.zero_flag = result == 0
+            if reg_c:
+                registers[reg_c] = result
+            return next_pc
+
+    elif opcode == 5:  # AND
+        def handler():
+            result = registers[reg_a] & registers[reg_b]
+            cpu.zero_flag = result == 0
+            if reg_c:
+                registers[reg_c] = result
+            return next_pc
+
+    elif opcode == 6:  # XOR
+        def handler():
+            result = registers[reg_a] ^ registers[reg_b]
+            cpu.zero_flag = result == 0
+            if reg_c:
+                registers[reg_c] = result
+            return next_pc
+
+    elif opcode == 7:  # RSH
+        def handler():
+            value = registers[reg_a]
+            cpu.carry_flag = value & 1
+            cpu.zero_flag = value < 2
+            if reg_c:
+                registers[reg_c] = value >> 1
+            return next_pc
+
+    elif opcode == 8:  # LDI
+        if reg_a:
+            def handler():
+                registers[reg_a] = imm
+                return next_pc
+        else:
+            def handler():
+                return next_pc
+
+    elif opcode == 9:  # ADI
+        if imm >= 0:
+            def handler():
+                result = registers[reg_a] + imm
+                cpu.carry_flag = result > 255
+                result &= 0xFF
+                cpu.zero_flag = result == 0
+                if reg_a:
+                    registers[reg_a] = result
+                return next_pc
+        else:
+            def handler():
+                result = registers[reg_a] + imm
+                cpu.carry_flag = result < 0
+                result &= 0xFF
+                cpu.zero_flag = result == 0
+                if reg_a:
+                    registers[reg_a] = result
+                return next_pc
+
+    elif opcode == 10:  # JMP
+        def handler():
+            return imm
+
+    elif opcode == 11:  # BRH, reg_a holds the condition
+        if reg_a == 0:  # EQ/Z
+            def handler():
+                return imm if cpu.zero_flag else next_pc
+        elif reg_a == 1:  # NE/NZ
+            def handler():
+                return next_pc if cpu.zero_flag else imm
+        elif reg_a == 2:  # GE/C
+            def handler():
+                return imm if cpu.carry_flag else next_pc
+        else:  # LT/NC
+            def handler():
+                return next_pc if cpu.carry_flag else imm
+
+    elif opcode == 12:  # CAL
+        stack = cpu.stack
+
+        def handler():
+            depth = cpu.stack_depth
+            if depth < 16:
+                stack[depth] = next_pc
+                cpu.stack_depth = depth + 1
+                return imm
+            print("⚠ Call stack overflow!")
+            return next_pc
+
+    elif opcode == 13:  # RET
+        stack = cpu.stack
+
+        def handler():
+            depth = cpu.stack_depth
+            if depth:
+                cpu.stack_depth = depth - 1
+                return stack[depth - 1]
+            print("⚠ Call stack underflow!")
+            return next_pc
+
+    elif opcode == 14:  # LOD
+        def handler():
+            addr = (registers[reg_a] + imm) & 0xFF
+            if addr >= 240:
+                return None
+            if reg_b:
+                registers[reg_b] = memory[addr]
+            return next_pc
+
+    else:  # STR
+        def handler():
+            addr = (registers[reg_a] + imm) & 0xFF
+            if addr >= 240:
+                return None
+            memory[addr] = registers[reg_b]
+            return next_pc
+
+    return handler
+
+
+def load_handlers(cpu):
+    """Return the handler table for the CPU's program
+
+    The table is padded past the end of the program (and of the 1024 word
+    address space), so any PC the program can reach indexes it without a
+    bounds check. Handlers close over the register, memory and call stack
+    objects, so the table is rebuilt if those change.
+    """
+    cached = cpu._compiled.get('threaded')
+    if (cached is None or cached[1] is not cpu.registers or cached[2] is not cpu.memory
+            or cached[3] is not cpu.stack):
+        handlers = [make_handler(cpu, pc, *instruction) for pc, instruction in enumerate(cpu._decoded)]
+        handlers += [_slow_path] * (max(len(handlers), 1024) + 1 - len(handlers))
+        cached = cpu._compiled['threaded'] = (handlers, cpu.registers, cpu.memory, cpu.stack)
+    return cached[0]
+
+
+def run_threaded(cpu, max_instructions):
+    """Run the CPU through its handler table"""
+    if cpu.halted:
+        return
+    handlers = load_handlers(cpu)
+    pc = cpu.pc
+    count = cpu.instruction_count
+    while count < max_instructions:
+        next_pc = handlers[pc]()
+        if next_pc is None:
+            # Let the interpreter execute this one with the state in sync
+            cpu.pc = pc
+            cpu.instruction_count = count
+            if not cpu.execute_one():
+                return
+            pc = cpu.pc
+            count = cpu.instruction_count
+            continue
+        pc = next_pc
+        count += 1
+    cpu.pc = pc
+    cpu.instruction_count = count
+
+
+def patch_handlers(cpu, pcs):
+    """Copy of the CPU's handler table with the handlers at pcs sent to the slow path"""
+    handlers = list(load_handlers(cpu))
+    for pc in pcs:
+        if 0 <= pc < len(handlers):
+            handlers[pc] = _slow_path
+    return handlers
+
+
+def run_traps(cpu, max_instructions, handlers, traps):
+    """Run like run_threaded() with a patched table and traps on the slow path
+
+    When the slow path is taken at a PC in traps, traps[pc](cpu,
+    max_instructions) is called first with the state in sync. It returns
+    True if it has moved the CPU on itself, False to have the interpreter
+    execute the instruction as usual.
+    """
+    if cpu.halted:
+        return
+    pc = cpu.pc
+    count = cpu.instruction_count
+    while count < max_instructions:
+        next_pc = handlers[pc]()
+        if next_pc is None:
+            cpu.pc = pc
+            cpu.instruction_count = count
+            trap = traps.get(pc)
+            if (trap is None or not trap(cpu, max_instructions)) and not cpu.execute_one():
+                return
+            pc = cpu.pc
+            count = cpu.instruction_count
+            continue
+        pc = next_pc
+        count += 1
+    cpu.pc = pc
+    cpu.instruction_count = count
@@ -0,0 +1,402 @@
+"""
+BatPU-2 Block Translator
+Translates programs into Python source, one function per basic block.
+
+Two engines are built on it:
+  aot     - translates the whole program up front and caches the compiled
+            code on disk keyed by the program hash
+  tiered  - interprets cold code and only compiles blocks once they are hot,
+            keeping them in a bounded LRU cache
+
+Program memory is never written at runtime, so a translation stays valid for
+as long as the program is loaded.
+"""
+
+import hashlib
+import importlib.util
+import marshal
+import os
+from collections import OrderedDict
+from cfg import BLOCK_TERMINATORS, program_cfg
+
+# Bump when the generated code changes, so stale cache entries are ignored
+TRANSLATOR_VERSION = 4
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'batpu2')
+
+BRANCH_TESTS = ('z', 'not z', 'c', 'not c')  # EQ, NE, GE, LT
+
+
+class BlockWriter:
+    """Generates the Python source of one basic block
+
+    Registers and flags live in locals for the duration of the block and are
+    written back to the CPU before leaving it, or before any I/O port access
+    so devices always see an up-to-date machine.
+    """
+
+    def __init__(self, decoded, start, end, name):
+        self.decoded = decoded
+        self.start = start
+        self.end = end
+        self.name = name
+        self.loads = set()      # registers read before being written
+        self.written = set()    # registers written so far
+        self.flags_read = set()
+        self.flags_written = set()
+        self.lines = []
+
+    def reg(self, index):
+        if index == 0:
+            return '0'
+        if index not in self.written:
+            self.loads.add(index)
+        return f'r{index}'
+
+    def flag(self, name):
+        if name not in self.flags_written:
+            self.flags_read.add(name)
+        return name
+
+    def set_flags(self, *names):
+        self.flags_written.update(names)
+
+    def set_reg(self, index, expr, indent='    '):
+        if index != 0:
+            self.written.add(index)
+            self.lines.append(f'{indent}r{index} = {expr}')
+
+    def writeback(self, indent='    '):
+        lines = [f'{indent}registers[{i}] = r{i}' for i in sorted(self.written)]
+        if 'z' in self.flags_written:
+            lines.append(f'{indent}cpu.zero_flag = z')
+        if 'c' in self.flags_written:
+            lines.append(f'{indent}cpu.carry_flag = c')
+        return lines
+
+    def sync(self, pc, indent):
+        """Bring the CPU fully up to date before handing control to a device"""
+        return self.writeback(indent) + [
+            f'{indent}cpu.pc = {pc}',
+            f'{indent}cpu.instruction_count = count + {pc - self.start}',
+        ]
+
+    def address(self, reg, offset):
+        if reg == 0:
+            return None, offset & 0xFF
+        expr = self.reg(reg)
+        if offset:
+            expr = f'({expr} + {offset}) & 255'
+        self.lines.append(f'    a = {expr}')
+        return 'a', None
+
+    def emit(self, pc, opcode, reg_a, reg_b, reg_c, imm):
+        out = self.lines.append
+        if opcode in (2, 3):  # ADD, SUB
+            op, carry = ('+', 't > 255') if opcode == 2 else ('-', 't >= 0')
+            out(f'    t = {self.reg(reg_a)} {op} {self.reg(reg_b)}')
+            out(f'    c = {carry}')
+            out('    t &= 255')
+            out('    z = t == 0')
+            self.set_flags('z', 'c')
+            self.set_reg(reg_c, 't')
+        elif opcode in (4, 5, 6):  # NOR, AND, XOR
+            a, b = self.reg(reg_a), self.reg(reg_b)
+            expr = {4: f'~({a} | {b}) & 255', 5: f'{a} & {b}', 6: f'{a} ^ {b}'}[opcode]
+            out(f'    t = {expr}')
+            out('    z = t == 0')
+            self.set_flags('z')
+            self.set_reg(reg_c, 't')
+        elif opcode == 7:  # RSH
+            a = self.reg(reg_a)
+            out(f'    t = {a} >> 1')
+            out(f'    c = {a} & 1')
+            out('    z = t == 0')
+            self.set_flags('z', 'c')
+            self.set_reg(reg_c, 't')
+        elif opcode == 8:  # LDI
+            self.set_reg(reg_a, str(imm))
+        elif opcode == 9:  # ADI
+            out(f'    t = {self.reg(reg_a)} + {imm}')
+            out('    c = t > 255' if imm >= 0 else '    c = t < 0')
+            out('    t &= 255')
+            out('    z = t == 0')
+            self.set_flags('z', 'c')
+            self.set_reg(reg_a, 't')
+        elif opcode == 14:  # LOD, reg B = memory[reg A + offset]
+            var, const = self.address(reg_a, imm)
+            if const is not None and const < 240:
+                if reg_b != 0:
+                    self.set_reg(reg_b, f'memory[{const}]')
+            elif const is not None:
+                self.lines += self.sync(pc, '    ')
+                self.set_reg(reg_b, f'cpu._port_readers[{const - 240}](cpu)')
+                if reg_b == 0:
+                    out(f'    cpu._port_readers[{const - 240}](cpu)')
+            else:
+                out(f'    if {var} >= 240:')
+                self.lines += self.sync(pc, '        ')
+                out(f'        t = cpu._port_readers[{var} - 240](cpu)')
+                out('    else:')
+                out(f'        t = memory[{var}]')
+                self.set_reg(reg_b, 't')
+        elif opcode == 15:  # STR, memory[reg A + offset] = reg B
+            var, const = self.address(reg_a, imm)
+            value = self.reg(reg_b)
+            if const is not None and const < 240:
+                out(f'    memory[{const}] = {value}')
+            elif const is not None:
+                self.lines += self.sync(pc, '    ')
+                out(f'    cpu._port_writers[{const - 240}](cpu, {value})')
+            else:
+                out(f'    if {var} >= 240:')
+                self.lines += self.sync(pc, '        ')
+                out(f'        cpu._port_writers[{var} - 240](cpu, {value})')
+                out('    else:')
+                out(f'        memory[{var}] = {value}')
+
+    def terminate(self, pc, opcode, reg_a, imm):
+        """Emit the block exit, returning the next PC (None halts)"""
+        out = self.lines.append
+        if opcode == 11:  # BRH, may need the flags loaded from the CPU
+            test = BRANCH_TESTS[reg_a]
+            self.flag(test[-1])
+        self.lines += self.writeback()
+        if opcode == 1:  # HLT
+            out(f'    cpu.pc = {pc}')
+            out('    cpu.halted = True')
+            out('    return None')
+        elif opcode == 10:  # JMP
+            out(f'    return {imm}')
+        elif opcode == 11:  # BRH
+            out(f'    return {imm} if {test} else {pc + 1}')
+        elif opcode == 12:  # CAL
+            out('    depth = cpu.stack_depth')
+            out('    if depth < 16:')
+            out(f'        cpu.stack[depth] = {pc + 1}')
+            out('        cpu.stack_depth = depth + 1')
+            out(f'        return {imm}')
+            out('    print("⚠ Call stack overflow!")')
+            out(f'    return {pc + 1}')
+        elif opcode == 13:  # RET
+            out('    depth = cpu.stack_depth')
+            out('    if depth:')
+            out('        cpu.stack_depth = depth - 1')
+            out('        return cpu.stack[depth - 1]')
+            out('    print("⚠ Call stack underflow!")')
+            out(f'    return {pc + 1}')
+        else:  # Falls through into the next block
+            out(f'    return {pc + 1}')
+
+    def write(self):
+        """Return (source, length) where length counts the instructions that retire"""
+        length = 0
+        last = None
+        for pc in range(self.start, self.end):
+            opcode, reg_a, reg_b, reg_c, imm = self.decoded[pc]
+            if opcode in BLOCK_TERMINATORS:
+                last = (pc, opcode, reg_a, imm)
+                break
+            self.emit(pc, opcode, reg_a, reg_b, reg_c, imm)
+            length += 1
+        if last is None:
+            self.terminate(self.end - 1, None, 0, 0)
+        else:
+            self.terminate(*last)
+            if last[1] != 1:  # HLT does not count as executed
+                length += 1
+
+        header = [f'def {self.name}(cpu, registers, memory):']
+        header += [f'    r{i} = registers[{i}]' for i in sorted(self.loads)]
+        if 'z' in self.flags_read:
+            header.append('    z = cpu.zero_flag')
+        if 'c' in self.flags_read:
+            header.append('    c = cpu.carry_flag')
+        if any(self.decoded[pc][0] in (14, 15) for pc in range(self.start, self.end)):
+            header.append('    count = cpu.instruction_count')
+        return '\n'.join(header + self.lines), length
+
+
+def translate(decoded, leaders, digest=''):
+    """Translate a predecoded program into Python module source
+
+    leaders are the sorted basic block starts (see cfg.CFG). The module
+    defines one function per basic block plus BLOCKS, a dict of start
+    address -> (function, instruction count).
+    """
+    bounds = zip(leaders, leaders[1:] + [len(decoded)])
+    parts = [f'# Generated by translator.py v{TRANSLATOR_VERSION} for program {digest}']
+    entries = []
+    for start, end in bounds:
+        name = f'block_{start}'
+        source, length = BlockWriter(decoded, start, end, name).write()
+        parts.append(source)
+        entries.append(f'    {start}: ({name}, {length}),')
+    parts.append('BLOCKS = {\n' + '\n'.join(entries) + '\n}')
+    return '\n\n'.join(parts) + '\n'
+
+
+def cache_key(digest):
+    """Cache key for a program hash, tied to the translator and Python bytecode versions"""
+    tag = f'{digest}:{TRANSLATOR_VERSION}:{importlib.util.MAGIC_NUMBER.hex()}'
+    return hashlib.sha256(tag.encode()).hexdigest()
+
+
+def compile_program(decoded, leaders, digest, cache_dir=DEFAULT_CACHE_DIR):
+    """Return the code object for a program, from the disk cache when possible"""
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, cache_key(digest) + '.bin')
+        try:
+            with open(path, 'rb') as f:
+                return marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    code = compile(translate(decoded, leaders, digest), f'<batpu2 {digest[:12]}>', 'exec')
+
+    if path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                marshal.dump(code, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass  # The cache is only an optimisation
+    return code
+
+
+def load_blocks(cpu, cache_dir=DEFAULT_CACHE_DIR):
+    """Return per-address (block function, length, budget) tables for the CPU's program
+
+    A block's budget is the instructions it needs left to run: its length,
+    plus its HLT, which doesn't retire but only happens within the limit.
+    """
+    compiled = cpu._compiled.get('aot')
+    if compiled is None:
+        namespace = {}
+        graph = program_cfg(cpu)
+        exec(compile_program(cpu._decoded, graph.leaders, cpu.program_hash, cache_dir), namespace)
+        blocks = [None] * len(cpu._decoded)
+        lengths = [0] * len(cpu._decoded)
+        budgets = [0] * len(cpu._decoded)
+        for start, (function, length) in namespace['BLOCKS'].items():
+            blocks[start] = function
+            lengths[start] = length
+            budgets[start] = length + (cpu._decoded[graph.blocks[start].last][0] == 1)
+        compiled = cpu._compiled['aot'] = (blocks, lengths, budgets)
+    return compiled
+
+
+def run_aot(cpu, max_instructions):
+    """Run the CPU with translated blocks, stepping the interpreter in between
+
+    The interpreter takes over wherever no block starts at the current PC
+    (e.g. after single-stepping into the middle of one) and when a block
+    would overrun max_instructions.
+    """
+    blocks, lengths, budgets = load_blocks(cpu)
+    registers = cpu.registers
+    memory = cpu.memory
+    program_length = len(blocks)
+    while cpu.instruction_count < max_instructions:
+        pc = cpu.pc
+        if cpu.halted or pc >= program_length:
+            cpu.halted = True
+            break
+        block = blocks[pc]
+        length = lengths[pc]
+        if block is None or cpu.instruction_count + budgets[pc] > max_instructions:
+            if not cpu.execute_one():
+                break
+            continue
+        count = cpu.instruction_count
+        next_pc = block(cpu, registers, memory)
+        # Blocks with I/O update the count themselves before each port access
+        cpu.instruction_count = count + length
+        if next_pc is None:
+            break
+        cpu.pc = next_pc
+
+
+class BlockCache:
+    """Hotness counters and a bounded LRU cache of compiled blocks for one program
+
+    Blocks are only compiled once they have been entered `threshold` times,
+    so run-once initialisation code stays in the interpreter. When the cache
+    is full the least recently used block is evicted and has to earn its
+    place again.
+    """
+
+    def __init__(self, decoded, leaders, threshold=16, capacity=128):
+        self.decoded = decoded
+        self.threshold = threshold
+        self.capacity = capacity
+        self.is_leader = [False] * len(decoded)
+        self.block_end = [0] * len(decoded)
+        for start, end in zip(leaders, leaders[1:] + [len(decoded)]):
+            self.is_leader[start] = True
+            self.block_end[start] = end
+        self.counters = [0] * len(decoded)
+        self.blocks = OrderedDict()  # start address -> (function, length, budget), see load_blocks()
+        self.compiled = 0
+        self.evictions = 0
+
+    def compile(self, start):
+        """Compile the block starting at a leader and add it to the cache"""
+        name = f'block_{start}'
+        end = self.block_end[start]
+        source, length = BlockWriter(self.decoded, start, end, name).write()
+        namespace = {}
+        exec(compile(source, f'<batpu2 block {start}>', 'exec'), namespace)
+        self.blocks[start] = (namespace[name], length, length + (self.decoded[end - 1][0] == 1))
+        self.compiled += 1
+        if len(self.blocks) > self.capacity:
+            evicted, _ = self.blocks.popitem(last=False)
+            self.counters[evicted] = 0
+            self.evictions += 1
+
+
+def block_cache(cpu):
+    """Return the tiered block cache for the CPU's program"""
+    cache = cpu._compiled.get('tiered')
+    if cache is None:
+        cache = cpu._compiled['tiered'] = BlockCache(cpu._decoded, program_cfg(cpu).leaders)
+    return cache
+
+
+def run_tiered(cpu, max_instructions):
+    """Interpret cold code and run hot blocks from the block cache"""
+    cache = block_cache(cpu)
+    blocks = cache.blocks
+    counters = cache.counters
+    is_leader = cache.is_leader
+    threshold = cache.threshold
+    registers = cpu.registers
+    memory = cpu.memory
+    program_length = len(is_leader)
+    while cpu.instruction_count < max_instructions:
+        pc = cpu.pc
+        if cpu.halted or pc >= program_length:
+            cpu.halted = True
+            break
+        entry = blocks.get(pc)
+        if entry is not None:
+            block, length, budget = entry
+            count = cpu.instruction_count
+            if count + budget <= max_instructions:
+                blocks.move_to_end(pc)
+                next_pc = block(cpu, registers, memory)
+                cpu.instruction_count = count + length
+                if next_pc is None:
+                    break
+                cpu.pc = next_pc
+                continue
+        elif is_leader[pc]:
+            counters[pc] += 1
+            if counters[pc] >= threshold:
+                cache.compile(pc)
+                continue
+        if not cpu.execute_one():
+            break
@@ -3,9 +3,11 @@ let grid;
 let previousRegisters = new Array(16).fill(0);
 let previousMemory = new Array(256).fill(0);
 let memoryPage = 0;
+let heatmapEnabled = false;
 let regFormat = 0; // 0=DEC, 1=HEX, 2=BIN
 let execStartTime = 0;
 let lastInstrCount = 0;
+let lastFrameHash = null;
 
 document.addEventListener('DOMContentLoaded', () => {
     console.log('DOM loaded, starting init...');
@@ -293,6 +295,36 @@ async function step() {
     }
 }
 
+async function reverseStep() {
+    try {
+        execStartTime = Date.now();
+        const res = await fetch('/api/reverse-step', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ count: 1 })
+        });
+        const data = await res.json();
+        render(data);
+        await getDisasm();
+        updateExecStats(data);
+    } catch (e) {
+        msg('Erreur: ' + e.message, 'err');
+    }
+}
+
+async function reverseContinue() {
+    try {
+        execStartTime = Date.now();
+        const res = await fetch('/api/reverse-continue', { method: 'POST' });
+        const data = await res.json();
+        render(data);
+        await getDisasm();
+        updateExecStats(data);
+    } catch (e) {
+        msg('Erreur: ' + e.message, 'err');
+    }
+}
+
 async function run() {
     try {
         execStartTime = Date.now();
@@ -305,6 +337,8 @@ async function run() {
         render(data);
         await getDisasm();
         updateExecStats(data);
+        if (data.stoppedAt) msg(`Arrêt: ${data.stoppedAt}`, 'ok');
+        else if (data.idleSkipped) msg(`Attente d'entrée: ${data.idleSkipped.toLocaleString()} instructions sautées`, 'ok');
     } catch (e) {
         msg('Erreur: ' + e.message, 'err');
     }
@@ -386,6 +420,21 @@ function setMemPage(page) {
     getState();
 }
 
+async function toggleHeatmap() {
+    try {
+        heatmapEnabled = !heatmapEnabled;
+        $('heatBtn').classList.toggle('active', heatmapEnabled);
+        const res = await fetch('/api/heatmap', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ enabled: heatmapEnabled })
+        });
+        render(await res.json());
+    } catch (e) {
+        msg('Erreur: ' + e.message, 'err');
+    }
+}
+
 // ==========================================
 // Render Functions
 // ==========================================
@@ -524,6 +573,13 @@ function render(d) {
         while (fullMemory.length < 256) fullMemory.push(0);
         const pageMemory = fullMemory.slice(start, end);
 
+        // Heatmap: log scale of LOD+STR count against the hottest address
+        const heat = d.heatmap;
+        let maxHeat = 0;
+        if (heat) {
+            for (let i = 0; i < 256; i++) maxHeat = Math.max(maxHeat, heat.reads[i] + heat.writes[i]);
+        }
+
         mem.innerHTML = pageMemory.map((v, i) => {
             const globalIdx = start + i;
             const changed = v !== previousMemory[globalIdx];
@@ -532,7 +588,18 @@ function render(d) {
             if (v) classes.push('active');
             if (changed) classes.push('changed');
             if (isPort) classes.push('port');
-            return `<div class="${classes.join(' ')}" title="[${globalIdx}]=${v}">${v.toString(16).padStart(2, '0').toUpperCase()}</div>`;
+            let title = `[${globalIdx}]=${v}`;
+            let style = '';
+            if (heat) {
+                const reads = heat.reads[globalIdx];
+                const writes = heat.writes[globalIdx];
+                title += ` R:${reads} W:${writes}`;
+                if (maxHeat && reads + writes) {
+                    const level = Math.log(1 + reads + writes) / Math.log(1 + maxHeat);
+                    style = ` style="background: rgba(255, 90, 0, ${(0.15 + 0.85 * level).toFixed(2)})"`;
+                }
+            }
+            return `<div class="${classes.join(' ')}"${style} title="${title}">${v.toString(16).padStart(2, '0').toUpperCase()}</div>`;
         }).join('');
 
         // ASCII view
@@ -557,9 +624,10 @@ function render(d) {
         }
     }
 
-    // Screen
+    // Screen (skipped when the frame hash says nothing changed)
     const screen = $('screen');
-    if (screen && d.screen) {
+    if (screen && d.screen && d.frameHash !== lastFrameHash) {
+        lastFrameHash = d.frameHash;
         const pixels = screen.querySelectorAll('.pixel');
         const flat = d.screen.flat();
         pixels.forEach((p, i) => {
@@ -650,6 +718,11 @@ document.addEventListener('keydown', (e) => {
         e.preventDefault();
         step();
     }
+    else if (e.key === 'F7') {
+        e.preventDefault();
+        if (e.shiftKey) reverseContinue();
+        else reverseStep();
+    }
     else if (e.key === 'F8') {
         e.preventDefault();
         reset();